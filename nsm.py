@@ -3,17 +3,38 @@
 """https://github.com/rbeede/network-stability-monitor"""
 
 # Python3 built-ins
+# Anything slow to import (asyncio, concurrent.futures, http.server, multiprocessing, sqlite3, subprocess, requests, dnspython) is imported where it is
+# first needed so the heartbeat starts without waiting on modules it does not use, see nsm.py bench startup
+import argparse
+import array
+import atexit
+import bisect
+import collections
+import ctypes
 import datetime
-import dns.rdatatype
-import dns.resolver
+import glob
+import gzip
+import heapq
+import ipaddress
 import itertools
+import json
 import logging
-from logging.handlers import RotatingFileHandler
-import multiprocessing
-import requests
-import subprocess
+from logging.handlers import QueueHandler, RotatingFileHandler
+import math
+import mmap
+import os
+import queue
+import random
+import re
+import select
+import shutil
+import socket
+import struct
 import sys
+import threading
 import time
+import urllib.parse
+import zlib
 
 __author__ = "Rodney Beede"
 __copyright__ = "© 2025 Rodney Beede"
@@ -26,12 +47,52 @@ logger = logging.getLogger(__name__)
 
 
 class Config():
+    # 'threaded' blocks the main loop on each check, 'asyncio' drives everything from one event loop
+    ENGINE = 'threaded'
+
     MONITORING_INTERVAL = 1.0  # seconds
 
+    # What to do with ticks that were due while a check overran the interval
+    #   'skip' drops them and continues at the next future tick
+    #   'catch-up' runs them back to back until on schedule again
+    # Either way they are logged as a coverage gap because the monitor was not watching at their time
+    OVERRUN_POLICY = 'skip'
+
+    # Adaptive heartbeat: speed up to ADAPTIVE_FAST_INTERVAL right after a failed or slow heartbeat, then back off
+    # by ADAPTIVE_BACKOFF per tick to MONITORING_INTERVAL, and after ADAPTIVE_STABLE_PERIOD without trouble
+    # further down to ADAPTIVE_SLOW_INTERVAL
+    ADAPTIVE_INTERVAL = False
+    ADAPTIVE_FAST_INTERVAL = 0.5  # seconds
+    ADAPTIVE_SLOW_INTERVAL = 10.0  # seconds
+    ADAPTIVE_BACKOFF = 1.5
+    ADAPTIVE_STABLE_PERIOD = 3600  # seconds
+    ADAPTIVE_SLOW_HEARTBEAT = 0.25  # seconds, a heartbeat taking longer than this counts as trouble
+
+    # High resolution mode for drops shorter than MONITORING_INTERVAL + TIMEOUT, None turns it off
+    # Every tick sends one prebuilt DNS query and waits at most this fraction of the tick for the answer
+    MICRO_INTERVAL = None  # seconds, 0.05 to 0.2 is sensible
+    MICRO_TIMEOUT_FRACTION = 0.8
+    # Consecutive failed ticks needed to call it a micro outage instead of a lost packet
+    MICRO_MIN_FAILED_TICKS = 2
+    # How often tick jitter and CPU use per tick are logged
+    MICRO_REPORT_INTERVAL = 60  # seconds
+
+    # Send prebuilt DNS query packets from persistent sockets instead of building a dnspython Resolver every interval
+    HEARTBEAT_FAST_PATH = True
+
+    # When the heartbeat resolver has not answered after this fraction of TIMEOUT the same query also goes to
+    # this many of the other DNS pairs and the first good answer counts, None turns hedging off
+    # Only the fast path hedges
+    HEARTBEAT_HEDGE_FRACTION = 0.5
+    HEARTBEAT_HEDGE_PAIRS = 2
+
     TIMEOUT = 1  # seconds
 
     OUTAGE_THRESHOLD = 25 / 100  # percent
 
+    # How often a probe waiting on a subprocess checks if the deep check no longer needs it
+    CANCEL_POLL_INTERVAL = 0.05  # seconds
+
     # If any one of these pass then outage is considered over
     #   Best to pick remotes and nothing on local network
     # IP of DNS resolver to use
@@ -54,6 +115,11 @@ class Config():
         ('100.127.255.1', 'ISP Uplink Tier'),
     ]
 
+    # Probe target hostnames are resolved in the background and re-resolved when their TTL runs out
+    # A TTL is never treated as shorter than this so short TTLs do not turn into a stream of lookups
+    ADDRESS_CACHE_MIN_TTL = 30  # seconds
+    ADDRESS_CACHE_RETRY = 10  # seconds before retrying a failed lookup
+
     # Used to verify if outage is real
     WEB_TARGETS = [
         # Using http: (instead of https) on purpose for faster handshakes
@@ -65,184 +131,3839 @@ class Config():
         'http://www.rodneybeede.com/',  # best website ever
     ]
 
+    # Extra endpoints watched on their own schedule, separate from outage detection
+    # Each is a dict like {'kind': 'icmp', 'target': '10.1.2.1', 'name': 'Branch 12 gateway', 'interval': 5}
+    # kind is 'icmp' or 'web' (target is then a URL), interval, jitter and timeout are optional seconds
+    # Can also be loaded from a JSON file holding a list of these with --targets
+    MONITORED_TARGETS = []
+    TARGET_DEFAULT_INTERVAL = 10.0  # seconds
+    TARGET_DEFAULT_JITTER = 0.5  # seconds, each probe runs up to this much before or after its due time
+    TARGET_WORKERS = 32  # probes running at once, a due probe is skipped if all are busy
+    TARGET_WHEEL_TICK = 0.05  # seconds per timing wheel slot
+    TARGET_WHEEL_SLOTS = 512
+    TARGET_REPORT_INTERVAL = 60  # seconds between scheduler lag reports
 
-def main():
-    setup_logging(sys.argv[1])
+    # Log records wait here for the writer thread so a slow disk never delays a probe
+    # When it is full DEBUG records are dropped and counted, anything more important waits for room
+    LOG_QUEUE_SIZE = 10000
+    LOG_BATCH_SIZE = 500  # records written between flushes at most
 
-    config = Config()
+    # The log is rotated when it reaches LOG_MAX_BYTES or every LOG_ROTATE_INTERVAL (None for size only)
+    # Rotated files are compressed in the background, only the newest LOG_BACKUP_COUNT are kept when it is set
+    LOG_MAX_BYTES = 100 * 1024 * 1024  # MiB
+    LOG_ROTATE_INTERVAL = 24 * 60 * 60  # seconds, rotates at UTC midnight
+    LOG_BACKUP_COUNT = None  # None or 0 keeps every rotated log
+    LOG_COMPRESSION = 'gzip'  # 'gzip', 'zstd' (needs the zstandard package) or None
 
-    start_of_failure = None
-    last_success = None
+    # Directory for the binary record of every heartbeat and deep check probe, None to not keep one
+    TIMESERIES_DIR = None
+    TIMESERIES_BATCH = 60  # records buffered before they are written out
 
-    for dns_pair in itertools.cycle(config.DNS_PAIRS):
-        loop_start = time.time()
+    # Per target per minute log-linear histograms of probe round trip times kept in memory
+    LATENCY_HISTOGRAM_MINUTES = 60  # minutes kept per target, None to not keep any
+    LATENCY_SUB_BUCKET_BITS = 5  # 32 buckets per power of two, about 3% relative error
+    LATENCY_REPORT_INTERVAL = 3600  # seconds between logging p50/p99/p99.9 per target, None to not log them
 
-        logger.debug(f"Interval check using {dns_pair}")
+    # Rolling 5 minute, 1 hour and 24 hour latency quantiles per target from bounded size sketches
+    LATENCY_BASELINES = True
+    LATENCY_SKETCH_ACCURACY = 0.02  # relative error of a quantile
+    LATENCY_SKETCH_MAX_BUCKETS = 256  # the lowest buckets are folded together beyond this
+    LATENCY_ANOMALY_FACTOR = 3.0  # a heartbeat slower than this times its resolver's 1 hour p95 is an anomaly, None to not check
+    LATENCY_ANOMALY_MIN_SAMPLES = 100  # samples in the last hour before a baseline is trusted
 
-        dns_client = dns.resolver.Resolver(configure=False)
-        dns_client.nameservers=[dns_pair[0]]
-        dns_client.timeout=config.TIMEOUT  # if using multiple resolver servers how long to wait on each one
-        dns_client.lifetime=config.TIMEOUT  # how long to wait for the entire thing
-        dns_client.cache=None  # default
-        dns_client.retry_servfail=False  # default
+    # [ADDRESS:]PORT to serve Prometheus metrics on at /metrics, None for no endpoint
+    METRICS_LISTEN = None
+    METRICS_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]  # seconds
 
-        try:
-            answer = dns_client.resolve(
-                qname=dns_pair[1],
-                rdtype=dns.rdatatype.A,
-                tcp=False  # UDP
-                )
-        except (dns.resolver.LifetimeTimeout, dns.resolver.NoNameservers) as e:
-            logger.debug(e)
-            answer = None
+    # SQLite database journaling every outage, micro outage and false alarm, None to not keep one
+    OUTAGE_JOURNAL = None
+    JOURNAL_COMMIT_DELAY = 0.5  # seconds the writer gathers records before committing them together
 
-        if not answer:
-            logger.warning(f"Failed to resolve using {dns_pair}. Network may be down, kicking off deep check")
+    # SQLite database of per minute, hour and day availability and latency rollups, None to not keep one
+    ROLLUP_DB = None
+    ROLLUP_RETENTION = {'1m': 7 * 86400, '1h': 400 * 86400, '1d': None}  # seconds each level is kept, None for ever
 
-            if deep_check(config):
-                if start_of_failure:  # already in downime
-                    logger.debug('Already knew network down, network is still down')
-                else:
-                    logger.error('New outage detected')
-                    start_of_failure = time.time()
+    # File the outage state is checkpointed to on every heartbeat so a restarted monitor resumes an outage, None for none
+    OUTAGE_CHECKPOINT = None
+    CHECKPOINT_MAX_GAP = 300  # seconds since the last checkpointed heartbeat after which an outage is not resumed
+    CHECKPOINT_SYNC_INTERVAL = 1.0  # seconds between msyncs of plain heartbeats, outage start and end are synced at once
+
+
+class OutageTracker():
+    # Outage state shared by the heartbeat and the deep checks of either engine
+    def __init__(self):
+        self.start_of_failure = None
+        self.last_success = None
+
+        if outage_checkpoint is not None:
+            outage_checkpoint.restore(self)
+
+    def heartbeat_passed(self):
+        # Network is still up or came back up
+        self.last_success = time.time()
+
+        if self.start_of_failure:  # Just saw recovery from a failure
+            outage_duration_seconds = self.last_success - self.start_of_failure
+
+            logger.info('Saw recovery from network outage')
+            logger.info('Duration of outage was ' + str(datetime.timedelta(seconds=outage_duration_seconds)))
+            journal_outage_ended(self.start_of_failure, self.last_success)
+            rollup_outage_ended(self.start_of_failure, self.last_success)
+            metric_set('nsm_outage_start_timestamp_seconds', 0)
+            checkpoint_outage_state(None, self.last_success)
+
+        self.start_of_failure = None
+
+    def deep_check_finished(self, outage, started, failing_since=None):
+        # failing_since is the wall time the heartbeat started failing when known, otherwise the outage starts now
+        metric_inc('nsm_deep_checks_total')
+
+        if self.last_success is not None and self.last_success > started:
+            # Only possible with the asyncio engine where heartbeats keep running during a deep check
+            logger.debug('Heartbeat passed while deep check was running, ignoring deep check result')
+            return
+
+        if outage:
+            if self.start_of_failure:  # already in downime
+                logger.debug('Already knew network down, network is still down')
             else:
-                logger.debug('False alarm, deep check of network passed; no outage')
-                # We won't consider this a last_success; so if there was a current outage we don't reset it
-                # The next loop around needs to pass for that to occur
-        else:  # Network is still up or came back up
-            last_success = time.time()
-
-            if start_of_failure:  # Just saw recovery from a failure
-                outage_duration_seconds = last_success - start_of_failure
-
-                logger.info('Saw recovery from network outage')
-                logger.info('Duration of outage was ' + str(datetime.timedelta(seconds=outage_duration_seconds)))
-            
-            start_of_failure = None
-            logger.debug(f"Network connection test passed with DNS pair {dns_pair} answering " + "\t".join(str(x) for x in answer))
+                logger.error('New outage detected')
+                self.start_of_failure = failing_since or time.time()
+                journal_outage_started(self.start_of_failure, outage.failures)
+                rollup_outage_started(self.start_of_failure)
+                checkpoint_outage_state(self.start_of_failure, self.last_success)
+                metric_inc('nsm_outages_total')
+                metric_set('nsm_outage_start_timestamp_seconds', self.start_of_failure)
+        else:
+            logger.debug('False alarm, deep check of network passed; no outage')
+            metric_inc('nsm_false_alarms_total')
+            journal_record(JOURNAL_FALSE_ALARM, started, started + outage.duration, outage.failures)
+            # We won't consider this a last_success; so if there was a current outage we don't reset it
+            # The next loop around needs to pass for that to occur
 
 
-        # It may have taken more than the desired monitoring interval to complete all the above
-        # or it may have taken less time
-        # Calculate if we need to wait at all so we do not go too fast
-        time_taken = time.time() - loop_start
-        logger.debug(f"It took {time_taken} seconds to complete the last interval check")
-        if time_taken < config.MONITORING_INTERVAL:
-            logger.debug('Finished early so sleeping')
-            time_to_sleep_in_seconds = config.MONITORING_INTERVAL - time_taken
-            time.sleep(time_to_sleep_in_seconds)
+class FixedRateScheduler():
+    # Ticks at exact multiples of the interval on time.monotonic() so sleeps do not drift and clock steps do not matter
+    def __init__(self, interval, overrun_policy='skip'):
+        self.interval = interval
+        self.overrun_policy = overrun_policy
+        self.origin = None  # time.monotonic() of tick 0
+        self.next_tick = 0
+        self.due = None  # time.monotonic() the tick delay() was last asked about is due
+        self.last_missed_tick = -1  # so catching up does not count the same missed tick twice
+        self.missed_ticks = 0
+        self.blind_seconds = 0.0  # total length of the coverage gaps
 
+    def delay(self):
+        # Returns how long to sleep before the next tick and accounts for any ticks missed by an overrun
+        now = time.monotonic()
 
-def setup_logging(log_filepath):
-    handler = RotatingFileHandler(
-        filename=log_filepath,
-        maxBytes=20 * 1024 * 1024 * 1024,  # GiB
-        backupCount=0,
-        encoding='utf-8',
-    )
+        if self.origin is None:
+            self.origin = now
 
-    handler.setFormatter(
-        logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
-    )
+        due = self.due = self.origin + self.next_tick * self.interval
 
-    handler.setLevel(logging.DEBUG)
+        if now < due:
+            self.next_tick += 1
+            return due - now
 
-    logger.addHandler(handler)
+        # Ticks that were due before now other than the one we are about to run
+        missed = int((now - due) // self.interval)
+        first_missed = max(self.next_tick + 1, self.last_missed_tick + 1)
+        last_missed = self.next_tick + missed
 
-    logger.setLevel(logging.DEBUG)
+        if last_missed >= first_missed:
+            self.record_gap(last_missed - first_missed + 1, self.origin + first_missed * self.interval)
+            self.last_missed_tick = last_missed
 
+        if self.overrun_policy == 'skip':
+            self.next_tick += missed
 
-def deep_check(config):
-    number_total_checks_made = len(config.ICMP_TARGETS) + len(config.WEB_TARGETS)
-    number_failures = 0
+        self.next_tick += 1
+        return 0.0
 
-    # Possible network outage so run all these checks to verify if network looks down for most things or only a few
-    for target in config.ICMP_TARGETS:
-        logger.debug(f"Pinging {target}")
+    def wait(self):
+        time.sleep(self.delay())
+        self.tick_started()
+
+    def tick_started(self):
+        # How late the tick started, by an overrun or a slow wake up
+        metric_set('nsm_scheduler_lag_seconds', max(0.0, time.monotonic() - self.due))
+
+    def set_interval(self, interval):
+        # Following ticks are multiples of the new interval counted from the tick that just ran
+        if interval == self.interval or self.origin is None:
+            self.interval = interval
+            return
+
+        self.origin += (self.next_tick - 1) * self.interval
+        self.next_tick = 1
+        self.last_missed_tick = 0
+        self.interval = interval
+
+    def record_gap(self, missed, first_due):
+        gap_seconds = missed * self.interval
+        gap_start = datetime.datetime.now() - datetime.timedelta(seconds=time.monotonic() - first_due)
+
+        self.missed_ticks += missed
+        self.blind_seconds += gap_seconds
+        metric_inc('nsm_scheduler_missed_ticks_total', value=missed)
+        metric_inc('nsm_scheduler_blind_seconds_total', value=gap_seconds)
+
+        logger.warning(f"Coverage gap of {missed} missed ticks ({gap_seconds:.3f} seconds) starting {gap_start.isoformat(sep=' ', timespec='milliseconds')}, {self.blind_seconds:.3f} seconds blind in total")
 
-        if not ping(target[0], config.TIMEOUT):
-            logger.warning(f"Failed ICMP ping to {target}")
-            number_failures += 1
+
+class AdaptiveInterval():
+    # Picks the heartbeat interval from how things have been going, every change is logged so samples can be weighted
+    def __init__(self, config):
+        self.config = config
+        self.interval = config.MONITORING_INTERVAL
+        self.last_anomaly = time.monotonic()
+
+    def update(self, anomaly):
+        # Returns the interval to use from now on
+        now = time.monotonic()
+
+        if anomaly:
+            self.last_anomaly = now
+            interval = self.config.ADAPTIVE_FAST_INTERVAL
         else:
-            logger.debug(f"Successful ICMP ping to {target}")
+            if now - self.last_anomaly < self.config.ADAPTIVE_STABLE_PERIOD:
+                target = self.config.MONITORING_INTERVAL
+            else:
+                target = self.config.ADAPTIVE_SLOW_INTERVAL
+
+            interval = min(target, self.interval * self.config.ADAPTIVE_BACKOFF) if self.interval < target else target
+
+        if interval != self.interval:
+            logger.info(f"Heartbeat interval changed from {self.interval:.3f} to {interval:.3f} seconds")
+            self.interval = interval
+
+        return self.interval
+
+
+TFD_CLOEXEC = 0o2000000
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', timespec), ('it_value', timespec)]
+
+
+def timerfd_open(interval):
+    # Returns a timerfd on CLOCK_MONOTONIC that expires every interval seconds
+    if hasattr(os, 'timerfd_create'):  # Python 3.13+
+        fd = os.timerfd_create(time.CLOCK_MONOTONIC, flags=os.TFD_CLOEXEC)
+        os.timerfd_settime(fd, initial=interval, interval=interval)
+        return fd
+
+    libc = ctypes.CDLL(None, use_errno=True)
 
-    for target in config.WEB_TARGETS:
-        logger.debug(f"Web query to {target}")
+    fd = libc.timerfd_create(time.CLOCK_MONOTONIC, TFD_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
 
-        if website_alive(target, config.TIMEOUT):
-            logger.debug(f"Success web query to {target}")
+    seconds = int(interval)
+    nanoseconds = int(round((interval - seconds) * 1e9))
+    spec = itimerspec(timespec(seconds, nanoseconds), timespec(seconds, nanoseconds))
+
+    if libc.timerfd_settime(fd, 0, ctypes.byref(spec), None) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, os.strerror(errno))
+
+    return fd
+
+
+class TimerFdTicker():
+    # The kernel keeps the period so there is no drift or sleep rounding from Python
+    def __init__(self, interval):
+        self.interval = interval
+        self.fd = timerfd_open(interval)
+
+    def wait(self):
+        # Returns the number of expirations since the last wait, more than 1 means ticks were missed
+        return struct.unpack('=Q', os.read(self.fd, 8))[0]
+
+
+class SleepTicker():
+    # Same interface as TimerFdTicker for systems without timerfd
+    def __init__(self, interval):
+        self.interval = interval
+        self.scheduler = FixedRateScheduler(interval, 'skip')
+
+    def wait(self):
+        missed = self.scheduler.missed_ticks
+        self.scheduler.wait()
+        return 1 + self.scheduler.missed_ticks - missed
+
+
+def open_ticker(interval):
+    try:
+        ticker = TimerFdTicker(interval)
+    except (OSError, AttributeError) as e:
+        logger.debug(f"timerfd unavailable, using sleeps for ticks: {e}")
+        return SleepTicker(interval)
+
+    logger.debug(f"Using timerfd for {interval} second ticks")
+    return ticker
+
+
+class TickJitter():
+    # How late each tick ran compared to its ideal time and the CPU it used, logged every report_interval
+    def __init__(self, interval, report_interval):
+        self.interval = interval
+        self.report_interval = report_interval
+        self.origin = None
+        self.ticks = 0  # expirations since origin
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.report_start = now
+        self.lateness = []
+        self.cpu = []
+        self.missed = 0
+
+    def tick(self, expirations, now):
+        if self.origin is None:
+            self.origin = now - self.interval * (expirations - 1)
+
+        self.ticks += expirations
+        self.missed += expirations - 1
+        self.lateness.append(max(0.0, now - (self.origin + (self.ticks - 1) * self.interval)))
+
+    def tick_done(self, cpu_seconds, now):
+        self.cpu.append(cpu_seconds)
+
+        if now - self.report_start >= self.report_interval:
+            self.report()
+            self.reset(now)
+
+    def report(self):
+        if not self.lateness:
+            return
+
+        lateness = sorted(self.lateness)
+        p99 = lateness[min(len(lateness) - 1, int(len(lateness) * 0.99))]
+
+        logger.info(
+            f"Tick jitter over {len(lateness)} ticks: mean {sum(lateness) / len(lateness) * 1000:.3f} ms"
+            f" p99 {p99 * 1000:.3f} ms max {lateness[-1] * 1000:.3f} ms,"
+            f" CPU per tick mean {sum(self.cpu) / len(self.cpu) * 1e6:.1f} us max {max(self.cpu) * 1e6:.1f} us,"
+            f" {self.missed} missed ticks"
+        )
+
+
+def run_micro_monitor(config, tracker):
+    # Heartbeat every MICRO_INTERVAL with the cheapest probe, one prebuilt DNS query and no hedging
+    # Successful ticks are not logged, at 10 ticks a second that would be most of the log
+    interval = config.MICRO_INTERVAL
+    probe_timeout = interval * config.MICRO_TIMEOUT_FRACTION
+    escalate_after = max(1, int(config.TIMEOUT / interval))  # failed ticks before a deep check
+
+    heartbeat = DnsHeartbeat(config.DNS_PAIRS, probe_timeout)
+    ticker = open_ticker(interval)
+    jitter = TickJitter(interval, config.MICRO_REPORT_INTERVAL)
+
+    # Deep checks run beside the ticks so the heartbeat keeps timing the outage
+    import concurrent.futures
+    deep_checks = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='DeepCheck')
+    deep_check_future = None
+
+    failed_ticks = 0
+    first_failure = None
+
+    logger.info(f"Micro outage mode with {interval} second ticks")
+
+    for pair_index, dns_pair in itertools.cycle(enumerate(config.DNS_PAIRS)):
+        expirations = ticker.wait()
+        tick_start = time.monotonic()
+        cpu_start = time.process_time()
+
+        jitter.tick(expirations, tick_start)
+
+        answer = heartbeat.probe(pair_index)
+        record_sample(TIMESERIES_KIND_DNS, pair_index, bool(answer), time.monotonic() - tick_start)
+
+        if answer:
+            if failed_ticks and tracker.start_of_failure:
+                # A declared outage, heartbeat_passed() logs and records its recovery
+                logger.debug(f"Heartbeat back after {failed_ticks} failed ticks of a declared outage")
+            elif failed_ticks >= config.MICRO_MIN_FAILED_TICKS:
+                duration = tick_start - first_failure
+                logger.warning(f"Micro outage of {duration * 1000:.0f} ms ({failed_ticks} failed ticks)")
+                now = time.time()
+                journal_record(JOURNAL_MICRO_OUTAGE, now - duration, now, [])
+            elif failed_ticks:
+                logger.debug(f"Lost {failed_ticks} heartbeat ticks, below micro outage threshold")
+
+            failed_ticks = 0
+            tracker.heartbeat_passed()
         else:
-            logger.warning(f"Failed web HEAD query to {target}")
-            number_failures += 1
+            if not failed_ticks:
+                first_failure = tick_start
+            failed_ticks += 1
 
-    logger.debug(f"Out of {number_total_checks_made} checks made there were {number_failures} failures")
+            logger.debug(f"Heartbeat tick failed using {dns_pair}, {failed_ticks} in a row")
 
-    return number_failures > (number_total_checks_made * config.OUTAGE_THRESHOLD)  # if failures exceed percentage of total checks
+            if failed_ticks % escalate_after == 0 and (deep_check_future is None or deep_check_future.done()):
+                logger.warning(f"Heartbeat failed for {failed_ticks} ticks. Network may be down, kicking off deep check")
 
+                deep_check_started = time.time()
+                # The outage is timed from the first failed tick, not from when the deep check confirms it
+                failing_since = deep_check_started - (time.monotonic() - first_failure)
+                deep_check_future = deep_checks.submit(
+                    lambda started=deep_check_started, since=failing_since: tracker.deep_check_finished(deep_check(config), started, since)
+                )
 
+        jitter.tick_done(time.process_time() - cpu_start, time.monotonic())
+
+
+def build_dns_query(qname):
+    # Transaction ID 0 (replaced on each send), recursion desired, one question
+    packet = bytearray(struct.pack('!HHHHHH', 0, 0x0100, 1, 0, 0, 0))
+
+    for label in qname.rstrip('.').split('.'):
+        encoded = label.encode('idna')
+        packet += bytes([len(encoded)]) + encoded
+
+    packet += b'\x00' + struct.pack('!HH', 1, 1)  # A, IN
+
+    return packet
+
+
+class DnsHeartbeat():
+    # Each DNS pair gets its query built once in wire format and its own connected UDP socket
+    # A send only changes the 16-bit transaction ID and a reply is checked by its header alone
+    HEADER = struct.Struct('!HHHHHH')
+
+    def __init__(self, dns_pairs, timeout, port=53):
+        self.dns_pairs = dns_pairs
+        self.timeout = timeout
+        self.port = port
+        self.queries = [build_dns_query(qname) for _, qname in dns_pairs]
+        self.sockets = [None] * len(dns_pairs)
+        self.reply = bytearray(512)  # largest plain UDP DNS message
+        self.reply_view = memoryview(self.reply)
+
+        self.heartbeats = 0
+        self.hedges = 0  # heartbeats that had to ask other resolvers too
+        self.hedge_wins = 0  # hedged heartbeats answered by one of the other resolvers
+
+    @property
+    def hedge_rate(self):
+        return self.hedges / self.heartbeats if self.heartbeats else 0.0
+
+    def socket_for(self, index):
+        dns_socket = self.sockets[index]
+
+        if dns_socket is None:
+            dns_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                # Can fail with no route during an outage, it is created again next time
+                dns_socket.connect((self.dns_pairs[index][0], self.port))
+            except OSError:
+                dns_socket.close()
+                raise
+            self.sockets[index] = dns_socket
+
+        return dns_socket
+
+    def close_socket(self, index):
+        if self.sockets[index] is not None:
+            self.sockets[index].close()
+            self.sockets[index] = None
+
+    def probe(self, index, timeout=None):
+        # Returns the number of answer records, 0 if there was no good answer in time
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        self.heartbeats += 1
+
+        pending = {}
+        self.send(index, pending)
+
+        return self.wait(pending, deadline)[1]
+
+    def hedged_probe(self, index, hedge_after, hedge_pairs, timeout=None):
+        # Returns (index of the pair that answered or None, number of answer records, seconds from the query to
+        # that pair until its answer or None), a hedge's time does not include the wait on the primary
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+
+        self.heartbeats += 1
+
+        pending = {}
+        self.send(index, pending)
+
+        answered_by, answer_count, rtt = self.wait(pending, min(deadline, time.monotonic() + hedge_after), give_up=False)
+        if answered_by is not None or time.monotonic() >= deadline:
+            return answered_by, answer_count, rtt
+
+        # Primary is slow or failed, ask others while still listening for the primary
+        self.hedges += 1
+        metric_inc('nsm_heartbeat_hedges_total')
+        others = [(index + offset) % len(self.dns_pairs) for offset in range(1, min(hedge_pairs, len(self.dns_pairs) - 1) + 1)]
+        for other in others:
+            self.send(other, pending)
+
+        logger.debug(f"Hedged heartbeat from {self.dns_pairs[index]} to {[self.dns_pairs[other] for other in others]}, hedge rate {self.hedge_rate:.2%}")
+
+        answered_by, answer_count, rtt = self.wait(pending, deadline)
+        if answered_by is not None and answered_by != index:
+            self.hedge_wins += 1
+
+        return answered_by, answer_count, rtt
+
+    def send(self, index, pending):
+        # Adds index -> (transaction ID, time.monotonic() sent) to pending if the query went out
+        query = self.queries[index]
+        transaction_id = random.getrandbits(16)
+        struct.pack_into('!H', query, 0, transaction_id)
+
+        try:
+            self.socket_for(index).send(query)
+        except OSError as e:
+            # No route during an outage for example
+            logger.debug(f"DNS query to {self.dns_pairs[index]} failed: {e}")
+            self.close_socket(index)
+            return
+
+        pending[index] = (transaction_id, time.monotonic())
+
+    def wait(self, pending, deadline, give_up=True):
+        # Returns (index, answer count, round trip time) of the first good answer from pending or (None, 0, None)
+        # pending loses the entries that failed, with give_up=False a slow resolver is left in pending
+        while pending:
+            remaining = deadline - time.monotonic()
+            readable = select.select([self.sockets[index] for index in pending], [], [], remaining)[0] if remaining > 0 else []
+
+            if not readable:
+                if give_up:
+                    for index in pending:
+                        logger.debug(f"DNS query to {self.dns_pairs[index]} timed out")
+                    pending.clear()
+                return None, 0, None
+
+            for index, (transaction_id, sent) in list(pending.items()):
+                dns_socket = self.sockets[index]
+                if dns_socket not in readable:
+                    continue
+
+                try:
+                    size = dns_socket.recv_into(self.reply_view)
+                except OSError as e:
+                    # Includes ICMP port unreachable reported on the connected socket
+                    logger.debug(f"DNS query to {self.dns_pairs[index]} failed: {e}")
+                    self.close_socket(index)
+                    del pending[index]
+                    continue
+
+                if size < self.HEADER.size:
+                    continue
+
+                reply_id, flags, _, answer_count, _, _ = self.HEADER.unpack_from(self.reply)
+                if reply_id != transaction_id or not flags & 0x8000:
+                    continue  # late reply to an earlier query or not a response at all
+
+                rcode = flags & 0x000f
+                if rcode != 0:
+                    logger.debug(f"DNS query to {self.dns_pairs[index]} answered with rcode {rcode}")
+                    del pending[index]
+                    continue
+
+                if answer_count:
+                    return index, answer_count, time.monotonic() - sent
+
+                logger.debug(f"DNS query to {self.dns_pairs[index]} answered with no records")
+                del pending[index]
+
+        return None, 0, None
+
+
+def resolve_heartbeat(dns_pair, timeout):
+    import dns.rdatatype
+    import dns.resolver
+
+    dns_client = dns.resolver.Resolver(configure=False)
+    dns_client.nameservers=[dns_pair[0]]
+    dns_client.timeout=timeout  # if using multiple resolver servers how long to wait on each one
+    dns_client.lifetime=timeout  # how long to wait for the entire thing
+    dns_client.cache=None  # default
+    dns_client.retry_servfail=False  # default
 
-def ping(target, timeout):
-    # To avoid needing elevated privileges for Python we call the external ping binary instead
-    # This is simpler for the install and usage of the program
-    # Currently only supports POSIX ping command options (no Windows)
     try:
-        completed_process = subprocess.run(
-            ['ping', '-b', '-c', '1', '-n', '-p', 'ff', '-W', str(timeout), target],
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            timeout=timeout * 1.25,  # Needs to be slightly longer than timeout above for ping command itself
+        return dns_client.resolve(
+            qname=dns_pair[1],
+            rdtype=dns.rdatatype.A,
+            tcp=False  # UDP
             )
-    except subprocess.TimeoutExpired as e:
-        # ping command could not complete (possible dns lookup delay of target) in time so return
+    except (dns.resolver.LifetimeTimeout, dns.resolver.NoNameservers) as e:
         logger.debug(e)
-        return False
-    
-    return completed_process.returncode == 0
+        return None
 
 
-def website_alive(url, timeout):
-    # If all dns times out it can force retries of dns that take longer than desired timeout
-    # So we have to use a Process inside to enforce request timeout
-    queue = multiprocessing.SimpleQueue()
-    process = multiprocessing.Process(
-        args=(url,timeout,queue),
-        name="TimedRequest",
-        target=website_alive_helper
+def bench_heartbeat(arguments):
+    # CPU time per heartbeat for the dnspython path and the fast path against the same resolver
+    config = Config()
+    dns_pair = config.DNS_PAIRS[arguments.pair]
+    heartbeat = DnsHeartbeat(config.DNS_PAIRS, config.TIMEOUT)
+
+    paths = [
+        ('dnspython', lambda: resolve_heartbeat(dns_pair, config.TIMEOUT)),
+        ('fast path', lambda: heartbeat.probe(arguments.pair)),
+    ]
+
+    print(f"{arguments.iterations} heartbeats against {dns_pair}")
+
+    for name, run in paths:
+        run()  # warm up
+
+        failures = 0
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(arguments.iterations):
+            if not run():
+                failures += 1
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+        print(f"{name:>10}: {cpu / arguments.iterations * 1e6:9.1f} us CPU/iteration  {wall / arguments.iterations * 1e3:7.3f} ms wall/iteration  {failures} failures")
+
+
+def bench_startup(arguments):
+    # Each run is a fresh interpreter that imports nsm and builds the heartbeat, timed from outside and by -X importtime
+    import subprocess
+
+    script = 'import nsm; nsm.DnsHeartbeat(nsm.Config.DNS_PAIRS, nsm.Config.TIMEOUT)'
+    walls = []
+    import_times = []
+
+    for _ in range(arguments.runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+        walls.append(time.perf_counter() - started)
+
+        # import time: self [us] | cumulative | imported package
+        imports = []
+        for line in result.stderr.splitlines():
+            fields = line[len('import time:'):].split('|')
+            if line.startswith('import time:') and fields[0].strip().isdigit():
+                imports.append((int(fields[1]), fields[2].rstrip()))
+        import_times.append(next((cumulative for cumulative, name in imports if name.strip() == 'nsm'), 0) / 1e6)
+
+    print(f"{arguments.runs} runs of {sys.executable}")
+    print(f"  start to heartbeat ready: median {sorted(walls)[len(walls) // 2] * 1000:.1f} ms  min {min(walls) * 1000:.1f} ms")
+    print(f"  import nsm: median {sorted(import_times)[len(import_times) // 2] * 1000:.1f} ms")
+    # Children are listed right before their parent, one level deeper
+    names = [name for _, name in imports]
+    end = names.index(' nsm') if ' nsm' in names else 0
+    begin = max((index for index, name in enumerate(names[:end]) if not name.startswith('  ')), default=-1) + 1
+    direct = [(cumulative, name.strip()) for cumulative, name in imports[begin:end] if not name.startswith('    ')]
+
+    print('Slowest imports of nsm in the last run (cumulative):')
+    for cumulative, name in sorted(direct, reverse=True)[:8]:
+        print(f"  {cumulative / 1000:7.1f} ms  {name}")
+
+
+def bench_analyze(arguments):
+    # Wall time of analyze_logs() per number of worker processes, the speedup is against the first job count
+    cpus = os.cpu_count() or 1
+    job_counts = arguments.jobs or [1 << power for power in range(cpus.bit_length()) if 1 << power <= cpus] + ([cpus] if cpus & (cpus - 1) else [])
+
+    for path in arguments.logs:
+        with open(path, 'rb') as log_file:
+            while log_file.read(LOG_GZIP_BLOCK):  # bring the logs into the page cache so every run reads from memory
+                pass
+
+    print(f"{cpus} CPUs")
+
+    baseline = None
+    for jobs in job_counts:
+        started = time.perf_counter()
+        analysis, scanned = analyze_logs(arguments.logs, 'day', jobs)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+
+        print(f"{jobs:>4} jobs: {elapsed:8.3f} s  {scanned / 1e6 / elapsed:8.0f} MB/s  speedup {baseline / elapsed:5.2f}  {analysis.outages} outages")
+
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} bench", description='Measure the cost of parts of the monitor')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    heartbeat_parser = subparsers.add_parser('heartbeat', help='CPU cost of one heartbeat query')
+    heartbeat_parser.add_argument('--iterations', type=int, default=1000)
+    heartbeat_parser.add_argument('--pair', type=int, default=0, help='index into Config.DNS_PAIRS')
+    heartbeat_parser.set_defaults(run=bench_heartbeat)
+
+    startup_parser = subparsers.add_parser('startup', help='time from starting python to a heartbeat being ready to send')
+    startup_parser.add_argument('--runs', type=int, default=10)
+    startup_parser.set_defaults(run=bench_startup)
+
+    analyze_parser = subparsers.add_parser('analyze', help='log analysis throughput with more and more worker processes')
+    analyze_parser.add_argument('logs', nargs='+', metavar='LOG')
+    analyze_parser.add_argument('--jobs', type=lambda value: [int(jobs) for jobs in value.split(',')], help='comma separated, default 1,2,4,... up to one per CPU')
+    analyze_parser.set_defaults(run=bench_analyze)
+
+    arguments = parser.parse_args(argv)
+
+    return arguments.run(arguments)
+
+
+def outages_main(argv):
+    import sqlite3
+
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} outages", description='Query the outage journal written with --journal')
+    parser.add_argument('journal', metavar='DB')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat, help='local date or time, e.g. 2025-03-01')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat, help='local date or time, exclusive')
+    parser.add_argument('--min-duration', type=float, metavar='SECONDS', help='only outages at least this long')
+    parser.add_argument(
+        '--classification',
+        choices=[JOURNAL_OUTAGE, JOURNAL_MICRO_OUTAGE, JOURNAL_FALSE_ALARM, 'all'],
+        default=JOURNAL_OUTAGE,
     )
+    parser.add_argument('--summary', action='store_true', help='count and total downtime instead of listing each outage')
+    parser.add_argument('--by', choices=['day', 'month'], help='summarise per local day or month')
+    arguments = parser.parse_args(argv)
 
-    process.start()
-    process.join(timeout)
+    if not os.path.exists(arguments.journal):
+        parser.error(f"no outage journal at {arguments.journal}")
 
-    if process.is_alive():
-        # It is still running in the background unsuccessfully
-        process.terminate()
-        process.join()
+    conditions = []
+    parameters = []
+    if arguments.since:
+        conditions.append('start >= ?')
+        parameters.append(arguments.since.timestamp())
+    if arguments.until:
+        conditions.append('start < ?')
+        parameters.append(arguments.until.timestamp())
+    if arguments.min_duration is not None:
+        conditions.append('duration >= ?')
+        parameters.append(arguments.min_duration)
+    if arguments.classification != 'all':
+        conditions.append('classification = ?')
+        parameters.append(arguments.classification)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
 
-        logger.debug(f"Timeout of {timeout} reached for {url}")
-        return False
+    connection = sqlite3.connect(f"file:{urllib.parse.quote(arguments.journal)}?mode=ro", uri=True)
 
-    response = queue.get()
-    logger.debug(f"website_alive: {response}")
-    # In the event the connection was made but no response do a sanity check
-    return response and response.headers
+    if arguments.summary or arguments.by:
+        group = {'day': '%Y-%m-%d', 'month': '%Y-%m', None: 'all'}[arguments.by]
+        rows = connection.execute(
+            f"SELECT strftime('{group}', start, 'unixepoch', 'localtime'), count(*), count(end), total(duration), avg(duration), max(duration)"
+            f" FROM outages{where} GROUP BY 1 ORDER BY 1",
+            parameters,
+        )
+        print(f"{'period':<10} {'count':>7} {'ongoing':>7} {'downtime':>16} {'mean':>10} {'longest':>16}")
+        for period, count, ended, downtime, mean, longest in rows:
+            print(
+                f"{period:<10} {count:>7} {count - ended:>7} {str(datetime.timedelta(seconds=round(downtime))):>16}"
+                f" {mean or 0:>9.1f}s {str(datetime.timedelta(seconds=round(longest or 0))):>16}"
+            )
+    else:
+        rows = connection.execute(f"SELECT start, end, duration, classification, failing_targets FROM outages{where} ORDER BY start", parameters)
+        for start, end, duration, classification, failing_targets in rows:
+            started = datetime.datetime.fromtimestamp(start).isoformat(sep=' ', timespec='seconds')
+            length = str(datetime.timedelta(seconds=round(duration, 3))) if end is not None else 'ongoing'
+            failing = ', '.join(json.loads(failing_targets))
+            print(f"{started}  {length:>16}  {classification:<11}  {failing}")
 
+    connection.close()
 
-def website_alive_helper(url, timeout, queue):
-    # Disable any retries
-    session = requests.sessions.Session()
-    adapter = requests.adapters.HTTPAdapter(max_retries=0)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
 
-    try:
-        response = session.head(url, timeout=timeout)
-    except Exception as e:
-        logger.debug(e)
-        queue.put(False)
+# Messages in the log the analyzer looks for, each is found with a plain substring search which runs at memchr speed
+LOG_MARKERS = {
+    b'New outage detected': 'outage',
+    b'Duration of outage was ': 'recovered',
+    b'False alarm, deep check': 'false_alarm',
+    b'Failed to resolve using (': 'resolve_failed',
+}
+LOG_GZIP_BLOCK = 16 * 1024 * 1024  # bytes of decompressed log scanned at a time
+LOG_MIN_CHUNK = 32 * 1024 * 1024  # smallest piece of a plain log handed to a worker process
+LOG_CHUNKS_PER_JOB = 4  # more chunks than workers so one slow chunk does not hold up the rest
+LOG_DURATION_PATTERN = re.compile(rb'(?:(\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def log_blocks(path):
+    # Yields the log as buffers that end on a line boundary, the whole file memory mapped or .gz decompressed a block at a time
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as log_file:
+            remainder = b''
+            while True:
+                block = log_file.read(LOG_GZIP_BLOCK)
+                if not block:
+                    break
+                block = remainder + block
+                cut = block.rfind(b'\n') + 1
+                remainder = block[cut:]
+                yield block[:cut]
+            if remainder:
+                yield remainder
         return
 
-    queue.put(response)
+    with open(path, 'rb') as log_file:
+        if os.fstat(log_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            yield log_map
+
+
+def log_marker_offsets(buffer, marker, start, end):
+    offset = buffer.find(marker, start, end)
+    while offset != -1:
+        yield offset, marker
+        offset = buffer.find(marker, offset + len(marker), end)
+
+
+def parse_log_timestamp(line):
+    # '2025-04-02 10:11:12,345 ...' as written by setup_logging(), None for continuation lines such as tracebacks
+    try:
+        return datetime.datetime.fromisoformat(line[:23].replace(b',', b'.').decode('ascii')).timestamp()
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def log_events(buffer, start=0, end=None):
+    # Yields (timestamp, event, detail) in file order for the marked lines in buffer[start:end]
+    # 'seen' events carry the first and last timestamps so the analysis knows the span the log covers
+    end = len(buffer) if end is None else end
+
+    first_line_end = buffer.find(b'\n', start, end)
+    timestamp = parse_log_timestamp(buffer[start:end if first_line_end == -1 else first_line_end])
+    if timestamp is not None:
+        yield timestamp, 'seen', None
+
+    offsets = [log_marker_offsets(buffer, marker, start, end) for marker in LOG_MARKERS]
+    for offset, marker in heapq.merge(*offsets):
+        line_start = buffer.rfind(b'\n', start, offset) + 1 or start
+        line_end = buffer.find(b'\n', offset, end)
+        line = buffer[line_start:end if line_end == -1 else line_end]
+
+        timestamp = parse_log_timestamp(line)
+        if timestamp is None:
+            continue
+
+        event = LOG_MARKERS[marker]
+        detail = None
+        if event == 'recovered':
+            match = LOG_DURATION_PATTERN.match(line, offset - line_start + len(marker))
+            if not match:
+                continue
+            days, hours, minutes, seconds = match.groups()
+            detail = int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        elif event == 'resolve_failed':
+            detail = line[offset - line_start + len(marker):].split(b')', 1)[0].decode('utf-8', 'replace')
+
+        yield timestamp, event, detail
+
+    last_line_end = end - 1 if end > start and buffer[end - 1:end] == b'\n' else end
+    timestamp = parse_log_timestamp(buffer[buffer.rfind(b'\n', start, last_line_end) + 1 or start:last_line_end])
+    if timestamp is not None:
+        yield timestamp, 'seen', None
+
+
+class LogAnalysis():
+    # Running totals over the events of one or more logs read in order, memory only grows with the number of periods
+    PERIOD_FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d'}
+
+    def __init__(self, period='day'):
+        self.period_format = self.PERIOD_FORMATS[period]
+        self.first_seen = None
+        self.last_seen = None
+        self.outages = 0  # recovered outages
+        self.downtime = 0.0
+        self.longest = 0.0
+        self.unrecovered = 0  # outages whose recovery never made it into the log, e.g. the monitor was restarted
+        self.open_start = None  # outage detected and not recovered yet
+        self.first_outage_event = None  # a chunk starting with 'recovered' closes the outage left open by the chunk before it
+        self.false_alarms = 0
+        self.resolver_failures = collections.Counter()
+        self.periods = {}  # period: [outages, downtime, false alarms]
+
+    def period(self, timestamp):
+        return self.periods.setdefault(time.strftime(self.period_format, time.localtime(timestamp)), [0, 0.0, 0])
+
+    def add(self, timestamp, event, detail):
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+        if event in ('outage', 'recovered') and self.first_outage_event is None:
+            self.first_outage_event = event
+
+        if event == 'outage':
+            if self.open_start is not None:
+                self.unrecovered += 1
+            self.open_start = timestamp
+        elif event == 'recovered':
+            # Duration lines give the exact start so an outage is counted when it ends
+            self.open_start = None
+            self.outages += 1
+            self.downtime += detail
+            self.longest = max(self.longest, detail)
+            counts = self.period(timestamp - detail)
+            counts[0] += 1
+            counts[1] += detail
+        elif event == 'false_alarm':
+            self.false_alarms += 1
+            self.period(timestamp)[2] += 1
+        elif event == 'resolve_failed':
+            self.resolver_failures[detail] += 1
+
+    def merge(self, later):
+        # Folds in the analysis of the part of the log right after this one, same result as reading both in one pass
+        for timestamp in (later.first_seen, later.last_seen):
+            if timestamp is not None:
+                self.add(timestamp, 'seen', None)
+
+        if self.open_start is not None and later.first_outage_event == 'outage':
+            self.unrecovered += 1
+        if later.first_outage_event is not None:
+            self.open_start = later.open_start
+        if self.first_outage_event is None:
+            self.first_outage_event = later.first_outage_event
+
+        self.outages += later.outages
+        self.downtime += later.downtime
+        self.longest = max(self.longest, later.longest)
+        self.unrecovered += later.unrecovered
+        self.false_alarms += later.false_alarms
+        self.resolver_failures.update(later.resolver_failures)
+
+        for period, (outages, downtime, false_alarms) in later.periods.items():
+            counts = self.periods.setdefault(period, [0, 0.0, 0])
+            counts[0] += outages
+            counts[1] += downtime
+            counts[2] += false_alarms
+
+    def mttr(self):
+        return self.downtime / self.outages if self.outages else None
+
+    def mtbf(self):
+        # Time up between failures, over the span the log covers
+        if not self.outages or self.first_seen is None:
+            return None
+        return max(0.0, self.last_seen - self.first_seen - self.downtime) / self.outages
+
+    def report(self):
+        def span(seconds):
+            return 'n/a' if seconds is None else str(datetime.timedelta(seconds=round(seconds)))
+
+        if self.first_seen is None:
+            print('No log lines found')
+            return
+
+        print(f"Log covers {datetime.datetime.fromtimestamp(self.first_seen)} to {datetime.datetime.fromtimestamp(self.last_seen)}")
+        print(f"Outages: {self.outages} recovered, {self.unrecovered} without a logged recovery")
+        if self.open_start is not None:
+            print(f"Outage still ongoing at end of log, started {datetime.datetime.fromtimestamp(self.open_start)}")
+        print(f"Downtime: {span(self.downtime)} total, {span(self.longest)} longest")
+        print(f"MTTR: {span(self.mttr())}  MTBF: {span(self.mtbf())}")
+        print(f"False alarms: {self.false_alarms}")
+
+        if self.resolver_failures:
+            print()
+            print('Heartbeat failures per resolver:')
+            for resolver, count in self.resolver_failures.most_common():
+                print(f"  {count:>8}  ({resolver})")
+
+        if self.periods:
+            print()
+            print(f"{'period':<16} {'outages':>7} {'downtime':>16} {'false alarms':>12}")
+            for period in sorted(self.periods):
+                outages, downtime, false_alarms = self.periods[period]
+                print(f"{period:<16} {outages:>7} {span(downtime):>16} {false_alarms:>12}")
+
+
+def log_chunks(path, count):
+    # Splits a plain log into about count (start, end) byte ranges that each begin at the start of a line
+    size = os.path.getsize(path)
+    count = max(1, min(count, size // LOG_MIN_CHUNK))
+    if count == 1:
+        return [(0, size)]
+
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+        boundaries = [0]
+        for index in range(1, count):
+            newline = log_map.find(b'\n', max(boundaries[-1], size * index // count))
+            if newline == -1:
+                break
+            boundaries.append(newline + 1)
+        boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def analyze_log_part(path, start, end, period):
+    # One unit of work for a worker process, a range of a plain log or a whole .gz log
+    analysis = LogAnalysis(period)
+    scanned = 0
+
+    if start is None:
+        for block in log_blocks(path):
+            scanned += len(block)
+            for timestamp, event, detail in log_events(block):
+                analysis.add(timestamp, event, detail)
+    else:
+        with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            for timestamp, event, detail in log_events(log_map, start, end):
+                analysis.add(timestamp, event, detail)
+        scanned = end - start
+
+    return analysis, scanned
+
+
+def analyze_logs(paths, period, jobs):
+    # Plain logs are split into chunks and .gz logs go whole, jobs processes analyze them and the results are merged in log order
+    parts = []
+    for path in paths:
+        if path.endswith('.gz'):
+            parts.append((path, None, None))
+        elif os.path.getsize(path):
+            parts.extend((path, start, end) for start, end in log_chunks(path, jobs * LOG_CHUNKS_PER_JOB if jobs > 1 else 1))
+
+    analysis = LogAnalysis(period)
+    scanned = 0
+
+    if jobs > 1 and len(parts) > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(parts))) as executor:
+            results = list(executor.map(analyze_log_part, *zip(*parts), itertools.repeat(period)))
+    else:
+        results = [analyze_log_part(path, start, end, period) for path, start, end in parts]
+
+    for part, part_scanned in results:
+        analysis.merge(part)
+        scanned += part_scanned
+
+    return analysis, scanned
+
+
+def analyze_main(argv):
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} analyze", description='Outage statistics from nsm log files')
+    parser.add_argument('logs', nargs='+', metavar='LOG', help='log files oldest first, rotated .gz files are read as they are')
+    parser.add_argument('--by', choices=['hour', 'day'], default='day', help='period to count outages in (default: day)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes (default: one per CPU)')
+    arguments = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    analysis, scanned = analyze_logs(arguments.logs, arguments.by, max(1, arguments.jobs))
+    elapsed = time.perf_counter() - started
+
+    analysis.report()
+    print(f"\nScanned {scanned / 1e6:.1f} MB in {elapsed:.2f} seconds ({scanned / 1e6 / max(elapsed, 1e-9):.0f} MB/s)", file=sys.stderr)
+
+
+def utc_datetime(value):
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+
+
+def rollups_main(argv):
+    import sqlite3
+
+    parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} rollups", description='Query the rollups written with --rollups')
+    parser.add_argument('rollups', metavar='DB')
+    parser.add_argument('--level', choices=[level for level, _ in ROLLUP_LEVELS], default='1d')
+    parser.add_argument('--since', type=utc_datetime, help='UTC date or time like the periods, e.g. 2025-03-01')
+    parser.add_argument('--until', type=utc_datetime, help='UTC date or time, exclusive')
+    parser.add_argument('--target', default=ROLLUP_NETWORK, help=f"'{ROLLUP_NETWORK}' (default) or a target such as 'icmp www.google.com'")
+    arguments = parser.parse_args(argv)
+
+    if not os.path.exists(arguments.rollups):
+        parser.error(f"no rollups at {arguments.rollups}")
+
+    connection = sqlite3.connect(f"file:{urllib.parse.quote(arguments.rollups)}?mode=ro", uri=True)
+    rows = connection.execute(
+        'SELECT start, successes, failures, outage_seconds, latency_count, latency_sum, latency_p50, latency_p95, latency_max'
+        ' FROM rollups WHERE level = ? AND target = ? AND start >= ? AND start < ? ORDER BY start',
+        (
+            arguments.level,
+            arguments.target,
+            arguments.since.timestamp() if arguments.since else 0,
+            arguments.until.timestamp() if arguments.until else float('inf'),
+        ),
+    )
+
+    def milliseconds(seconds):
+        return f"{seconds * 1000:.1f}" if seconds is not None else '-'
+
+    print(f"{'period (UTC)':<20} {'checks':>8} {'failed':>7} {'success':>8} {'outage':>10} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for start, successes, failures, outage_seconds, latency_count, latency_sum, p50, p95, slowest in rows:
+        checks = successes + failures
+        print(
+            f"{datetime.datetime.fromtimestamp(start, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M'):<20} {checks:>8} {failures:>7}"
+            f" {successes / checks * 100 if checks else 0:>7.3f}% {outage_seconds:>9.1f}s"
+            f" {milliseconds(latency_sum / latency_count if latency_count else None):>8} {milliseconds(p50):>8} {milliseconds(p95):>8} {milliseconds(slowest):>8}"
+        )
+
+    connection.close()
+
+
+# Run as nsm.py <subcommand> ... instead of monitoring
+SUBCOMMANDS = {
+    'analyze': analyze_main,
+    'bench': bench_main,
+    'outages': outages_main,
+    'rollups': rollups_main,
+}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log_filepath')
+    parser.add_argument(
+        '--engine',
+        choices=['threaded', 'asyncio'],
+        default=Config.ENGINE,
+        help=f"monitoring engine to run (default: {Config.ENGINE})",
+    )
+    parser.add_argument(
+        '--micro-interval',
+        type=float,
+        default=Config.MICRO_INTERVAL,
+        metavar='SECONDS',
+        help='heartbeat this often to catch sub-second outages (e.g. 0.1)',
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        default=Config.ADAPTIVE_INTERVAL,
+        help='speed the heartbeat up after trouble and slow it down while stable',
+    )
+    parser.add_argument(
+        '--targets',
+        metavar='FILE',
+        help='JSON file with a list of extra targets to watch, see Config.MONITORED_TARGETS',
+    )
+    parser.add_argument(
+        '--timeseries',
+        metavar='DIR',
+        default=Config.TIMESERIES_DIR,
+        help='keep a compact binary record of every heartbeat and probe in this directory',
+    )
+    parser.add_argument(
+        '--journal',
+        metavar='DB',
+        default=Config.OUTAGE_JOURNAL,
+        help='record every outage in this SQLite database, query it with the outages subcommand',
+    )
+    parser.add_argument(
+        '--rollups',
+        metavar='DB',
+        default=Config.ROLLUP_DB,
+        help='keep per minute, hour and day availability and latency in this SQLite database, query it with the rollups subcommand',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        metavar='FILE',
+        default=Config.OUTAGE_CHECKPOINT,
+        help='checkpoint the outage state here so an outage carries on across a restart or crash',
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='[ADDRESS:]PORT',
+        default=Config.METRICS_LISTEN,
+        help='serve Prometheus metrics at /metrics, on 127.0.0.1 unless an address is given',
+    )
+    parser.add_argument(
+        '--overrun',
+        choices=['skip', 'catch-up'],
+        default=Config.OVERRUN_POLICY,
+        help=f"what to do with ticks missed while a check overran the interval (default: {Config.OVERRUN_POLICY})",
+    )
+
+    arguments = parser.parse_args(argv)
+
+    # The asyncio engine heartbeats through dnspython at the normal interval only
+    if arguments.engine == 'asyncio' and arguments.micro_interval:
+        parser.error('--micro-interval is not supported with --engine asyncio')
+    if arguments.engine == 'asyncio' and arguments.adaptive:
+        parser.error('--adaptive is not supported with --engine asyncio')
+
+    return arguments
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
+    arguments = parse_arguments(sys.argv[1:])
+
+    setup_logging(arguments.log_filepath)
+
+    config = Config()
+    config.ENGINE = arguments.engine
+    config.OVERRUN_POLICY = arguments.overrun
+    config.MICRO_INTERVAL = arguments.micro_interval
+    config.ADAPTIVE_INTERVAL = arguments.adaptive
+    config.TIMESERIES_DIR = arguments.timeseries
+    config.OUTAGE_JOURNAL = arguments.journal
+    config.METRICS_LISTEN = arguments.metrics
+    config.ROLLUP_DB = arguments.rollups
+    config.OUTAGE_CHECKPOINT = arguments.checkpoint
+
+    if arguments.targets:
+        config.MONITORED_TARGETS = config.MONITORED_TARGETS + load_monitored_targets(arguments.targets)
+
+    start_timeseries_store(config)
+    start_latency_histograms(config)
+    start_latency_baselines(config)
+    start_outage_journal(config)
+    start_rollups(config)
+    start_metrics_server(config)
+    start_outage_checkpoint(config)
+
+    if config.ENGINE == 'asyncio':
+        import asyncio
+        return asyncio.run(async_main(config))
+
+    start_address_cache(config)
+
+    # Pre-warm the HTTP sandboxes now so a deep check does not have to fork any
+    # Monitored web targets get enough extra workers that they never starve the deep check
+    http_workers = max(1, len(config.WEB_TARGETS))
+    if any(target.get('kind') == 'web' for target in config.MONITORED_TARGETS):
+        http_workers += config.TARGET_WORKERS
+    start_http_probe_pool(http_workers)
+
+    start_target_monitor(config)
+
+    tracker = OutageTracker()
+
+    if config.MICRO_INTERVAL:
+        return run_micro_monitor(config, tracker)
+
+    heartbeat = DnsHeartbeat(config.DNS_PAIRS, config.TIMEOUT) if config.HEARTBEAT_FAST_PATH else None
+    scheduler = FixedRateScheduler(config.MONITORING_INTERVAL, config.OVERRUN_POLICY)
+    adaptive = AdaptiveInterval(config) if config.ADAPTIVE_INTERVAL else None
+
+    for pair_index, dns_pair in itertools.cycle(enumerate(config.DNS_PAIRS)):
+        scheduler.wait()
+        loop_start = time.monotonic()
+        answered_by = None
+        answer_time = None
+
+        logger.debug(f"Interval check using {dns_pair}")
+
+        if heartbeat is not None and config.HEARTBEAT_HEDGE_FRACTION is not None:
+            answered_by, answer, answer_time = heartbeat.hedged_probe(pair_index, config.TIMEOUT * config.HEARTBEAT_HEDGE_FRACTION, config.HEARTBEAT_HEDGE_PAIRS)
+            if answered_by is not None and answered_by != pair_index:
+                logger.debug(f"Hedged heartbeat answered by {config.DNS_PAIRS[answered_by]} instead of {dns_pair}")
+        elif heartbeat is not None:
+            answer = heartbeat.probe(pair_index)
+        else:
+            answer = resolve_heartbeat(dns_pair, config.TIMEOUT)
+
+        heartbeat_time = time.monotonic() - loop_start
+        # The latency of the resolver that answered, a hedge that won is not charged for the wait on the primary
+        answer_time = heartbeat_time if answer_time is None else answer_time
+        record_sample(TIMESERIES_KIND_DNS, pair_index if answered_by is None else answered_by, bool(answer), answer_time)
+        slow_heartbeat = bool(answer) and is_latency_anomaly(TIMESERIES_KIND_DNS, pair_index if answered_by is None else answered_by, answer_time)
+
+        if not answer:
+            logger.warning(f"Failed to resolve using {dns_pair}. Network may be down, kicking off deep check")
+
+            deep_check_started = time.time()
+            tracker.deep_check_finished(deep_check(config), deep_check_started)
+        else:
+            tracker.heartbeat_passed()
+            if heartbeat is not None:
+                logger.debug(f"Network connection test passed with DNS pair {dns_pair} answering with {answer} records")
+            else:
+                logger.debug(f"Network connection test passed with DNS pair {dns_pair} answering " + "\t".join(str(x) for x in answer))
+
+
+        # It may have taken more than the desired monitoring interval to complete all the above
+        # or it may have taken less time, the scheduler sleeps until the next tick or accounts for the overrun
+        time_taken = time.monotonic() - loop_start
+        logger.debug(f"It took {time_taken} seconds to complete the last interval check")
+
+        if adaptive is not None:
+            # A failed heartbeat covers false alarm deep checks too since those only follow a failure
+            scheduler.set_interval(adaptive.update(not answer or heartbeat_time > config.ADAPTIVE_SLOW_HEARTBEAT or slow_heartbeat))
+
+
+def setup_logging(log_filepath):
+    handler = CompressingRotatingFileHandler(
+        filename=log_filepath,
+        maxBytes=Config.LOG_MAX_BYTES,
+        backupCount=Config.LOG_BACKUP_COUNT,
+        encoding='utf-8',
+        rotate_interval=Config.LOG_ROTATE_INTERVAL,
+        compression=Config.LOG_COMPRESSION,
+    )
+
+    handler.setFormatter(
+        logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
+    )
+
+    handler.setLevel(logging.DEBUG)
+
+    # Probe threads only put records on a queue, the file is written by LogWriter
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize=Config.LOG_QUEUE_SIZE))
+    queue_handler.setLevel(logging.DEBUG)
+
+    writer = LogWriter(queue_handler, handler, Config.LOG_BATCH_SIZE)
+    writer.start()
+    atexit.register(writer.stop)
+
+    logger.addHandler(queue_handler)
+
+    logger.setLevel(logging.DEBUG)
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    # Rotates by size or time, renaming the log to log.YYYYmmdd-HHMMSS and handing it to a LogCompressor
+    # so the writer thread never waits on compression
+    def __init__(self, filename, maxBytes, backupCount, encoding, rotate_interval=None, compression=None):
+        super().__init__(filename=filename, maxBytes=maxBytes, backupCount=backupCount or 0, encoding=encoding)
+
+        self.rotate_interval = rotate_interval
+        self.rollover_at = self.next_rollover_time()
+        self.compressor = LogCompressor(self.baseFilename, backupCount, compression)
+        self.compressor.start()
+
+    def next_rollover_time(self):
+        if not self.rotate_interval:
+            return None
+
+        now = time.time()
+        return now - now % self.rotate_interval + self.rotate_interval
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        rotated = f"{self.baseFilename}.{time.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 1
+        while glob.glob(glob.escape(rotated) + '*'):
+            rotated = f"{self.baseFilename}.{time.strftime('%Y%m%d-%H%M%S')}-{suffix}"
+            suffix += 1
+
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, rotated)
+            self.compressor.submit(rotated)
+
+        self.rollover_at = self.next_rollover_time()
+        self.stream = self._open()
+
+    # emit() flushes after every record, LogWriter flushes once per batch instead
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class LogCompressor():
+    # Compresses rotated logs on its own thread then deletes the oldest beyond the retention count
+    # Only files named like a rotation, log.YYYYmmdd-HHMMSS[-N][.gz|.zst], are touched
+    SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, base_filename, retention, compression):
+        self.base_filename = base_filename
+        self.retention = retention
+        self.compression = compression
+        self.jobs = queue.Queue()
+        self.rotated_pattern = re.compile(re.escape(base_filename) + r'\.(\d{8}-\d{6})(?:-(\d+))?(\.gz|\.zst)?(\.tmp)?')
+
+        if compression == 'zstd':
+            try:
+                import zstandard  # optional
+            except ImportError:
+                logger.warning('zstandard is not installed, compressing rotated logs with gzip')
+                self.compression = 'gzip'
+
+    def start(self):
+        # Finish whatever a previous run left behind
+        for path in self.rotated_files(temporary=True):
+            os.remove(path)
+        for path in self.rotated_files():
+            if self.compression and not path.endswith(tuple(self.SUFFIXES.values())):
+                self.submit(path)
+
+        threading.Thread(target=self.run, name='LogCompressor', daemon=True).start()
+
+    def submit(self, path):
+        self.jobs.put(path)
+
+    def rotated_files(self, temporary=False):
+        # Oldest first by the timestamp in the name then by the -N suffix added when it collided
+        rotated = []
+        for path in glob.glob(glob.escape(self.base_filename) + '.*'):
+            match = self.rotated_pattern.fullmatch(path)
+            if match and bool(match.group(4)) == temporary:
+                rotated.append(((match.group(1), int(match.group(2) or 0)), path))
+
+        return [path for _, path in sorted(rotated)]
+
+    def run(self):
+        while True:
+            path = self.jobs.get()
+
+            if self.compression:
+                try:
+                    self.compress(path)
+                except OSError as e:
+                    logger.warning(f"Could not compress rotated log {path}: {e}")
+
+            self.enforce_retention()
+
+    def compress(self, path):
+        destination = path + self.SUFFIXES[self.compression]
+        temporary = destination + '.tmp'
+        started = time.monotonic()
+
+        with open(path, 'rb') as source, open(temporary, 'wb') as target:
+            if self.compression == 'zstd':
+                import zstandard
+                zstandard.ZstdCompressor().copy_stream(source, target)
+            else:
+                with gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=target) as compressed:
+                    shutil.copyfileobj(source, compressed, 1024 * 1024)
+
+        os.replace(temporary, destination)
+
+        original_size = os.path.getsize(path)
+        compressed_size = os.path.getsize(destination)
+        os.remove(path)
+
+        ratio = original_size / compressed_size if compressed_size else 0.0
+        logger.info(
+            f"Compressed rotated log {os.path.basename(path)} with {self.compression} from {original_size} to {compressed_size} bytes"
+            f" (ratio {ratio:.1f}) in {time.monotonic() - started:.3f} seconds"
+        )
+
+    def enforce_retention(self):
+        if not self.retention:
+            return
+
+        for path in self.rotated_files()[:-self.retention]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Could not remove old rotated log {path}: {e}")
+
+
+class BoundedQueueHandler(QueueHandler):
+    # Never blocks on DEBUG, those are dropped and counted when the queue is full
+    # INFO and above carry outages and recoveries so they wait for room instead
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if record.levelno > logging.DEBUG:
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metric_inc('nsm_log_records_dropped_total')
+
+
+class LogWriter():
+    # Writes queued log records to the file handler in batches with one flush per batch
+    STOP = None
+    DROP_REPORT_INTERVAL = 10  # seconds, so a long overflow does not fill the log with drop reports
+
+    def __init__(self, queue_handler, handler, batch_size):
+        self.queue = queue_handler.queue
+        self.queue_handler = queue_handler
+        self.handler = handler
+        self.batch_size = batch_size
+        self.reported_dropped = 0
+        self.next_drop_report = 0
+        self.thread = threading.Thread(target=self.run, name='LogWriter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(self.STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is self.STOP:
+                    self.report_dropped(force=True)
+                    self.handler.flush_batch()
+                    return
+                self.handler.handle(record)
+
+            self.report_dropped()
+            self.handler.flush_batch()
+
+    def report_dropped(self, force=False):
+        dropped = self.queue_handler.dropped
+        if dropped == self.reported_dropped or (not force and time.monotonic() < self.next_drop_report):
+            return
+
+        self.handler.handle(logger.makeRecord(
+            logger.name, logging.WARNING, __file__, 0,
+            f"Dropped {dropped - self.reported_dropped} DEBUG log records because the log queue was full, {dropped} in total",
+            None, None,
+        ))
+        self.reported_dropped = dropped
+        self.next_drop_report = time.monotonic() + self.DROP_REPORT_INTERVAL
+
+
+class DeepCheckResult():
+    def __init__(self, probes, duration, outage, cancelled=0):
+        self.probes = probes  # list of ProbeResult in order of completion
+        self.duration = duration  # seconds the whole deep check took
+        self.outage = outage
+        self.cancelled = cancelled  # probes no longer needed once the verdict was decided
+
+    @property
+    def failures(self):
+        return [probe for probe in self.probes if not probe.ok]
+
+    def __bool__(self):
+        # Callers treat the result of deep_check() as "is the network down"
+        return self.outage
+
+
+ProbeResult = collections.namedtuple('ProbeResult', ['kind', 'target', 'ok', 'latency'])
+
+
+class QuorumEvaluator():
+    # Decides the deep check verdict as soon as the probes still outstanding can no longer change it
+    def __init__(self, total, threshold):
+        self.total = total
+        self.limit = total * threshold  # outage when failures exceed this
+        self.failures = 0
+        self.successes = 0
+
+    def add(self, ok):
+        if ok:
+            self.successes += 1
+        else:
+            self.failures += 1
+
+        return self.verdict()
+
+    def remaining(self):
+        return self.total - self.failures - self.successes
+
+    def verdict(self):
+        # True is an outage, False is no outage and None means it is still undecided
+        if self.failures > self.limit:
+            return True
+
+        if self.failures + self.remaining() <= self.limit:
+            return False
+
+        return None
+
+
+def deep_check(config):
+    import concurrent.futures
+
+    check_start = time.monotonic()
+
+    probes = [('icmp', target) for target in config.ICMP_TARGETS] + [('web', target) for target in config.WEB_TARGETS]
+    number_total_checks_made = len(probes)
+    results = []
+
+    quorum = QuorumEvaluator(number_total_checks_made, config.OUTAGE_THRESHOLD)
+    verdict = quorum.verdict()
+    cancel = threading.Event()
+
+    # Possible network outage so run all these checks to verify if network looks down for most things or only a few
+    # Every probe is started at once so the whole check takes about one timeout instead of the sum of them
+    completed = queue.Queue()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, number_total_checks_made), thread_name_prefix='DeepCheck')
+
+    if config.ICMP_TARGETS and detect_icmp_socket_type():
+        # One socket and one thread pings every ICMP target
+        executor.submit(run_icmp_batch, completed, config.ICMP_TARGETS, config.TIMEOUT, cancel)
+        probes = [probe for probe in probes if probe[0] != 'icmp']
+
+    for kind, target in probes:
+        executor.submit(run_probe_into, completed, kind, target, config.TIMEOUT, cancel)
+
+    try:
+        while verdict is None:
+            result = completed.get()
+            results.append(result)
+            record_probe_result(config, result)
+
+            if result.ok:
+                logger.debug(f"Successful {result.kind} probe to {result.target} in {result.latency:.6f} seconds")
+            else:
+                logger.warning(f"Failed {result.kind} probe to {result.target} after {result.latency:.6f} seconds")
+
+            verdict = quorum.add(result.ok)
+            if verdict is not None:
+                break
+    finally:
+        # Once the verdict cannot change any probe still in flight is only sending packets for nothing
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    number_failures = quorum.failures
+    cancelled = quorum.remaining()
+    duration = time.monotonic() - check_start
+
+    if cancelled:
+        logger.debug(f"Deep check verdict decided early, cancelled {cancelled} remaining checks")
+
+    logger.debug(f"Out of {number_total_checks_made - cancelled} checks made there were {number_failures} failures, deep check took {duration:.6f} seconds")
+
+    # Same as failures exceeding the percentage of total checks had every check been run
+    return DeepCheckResult(results, duration, verdict, cancelled)
+
+
+def run_probe_into(completed, kind, target, timeout, cancel=None):
+    try:
+        result = run_probe(kind, target, timeout, cancel)
+    except Exception as e:
+        logger.debug(e)
+        result = ProbeResult(kind, target, False, 0.0)
+
+    completed.put(result)
+
+
+def run_icmp_batch(completed, targets, timeout, cancel=None):
+    batch_start = time.monotonic()
+    reported = set()
+
+    def on_result(host, rtt):
+        for target in targets:
+            if target[0] == host and target not in reported:
+                reported.add(target)
+                completed.put(ProbeResult('icmp', target, rtt is not None, time.monotonic() - batch_start if rtt is None else rtt))
+
+    try:
+        ping_many([target[0] for target in targets], timeout, cancel, on_result)
+    except Exception as e:
+        logger.debug(e)
+
+    # Anything not reported by now counts as a failure, otherwise the deep check would wait for it forever
+    for target in targets:
+        if target not in reported:
+            reported.add(target)
+            completed.put(ProbeResult('icmp', target, False, time.monotonic() - batch_start))
+
+
+def run_probe(kind, target, timeout, cancel=None):
+    probe_start = time.monotonic()
+
+    if kind == 'icmp':
+        rtt = ping_rtt(target[0], timeout, cancel)
+        if rtt is not None:
+            return ProbeResult(kind, target, True, rtt)
+        ok = False
+    else:
+        ok = bool(website_alive(target, timeout, cancel))
+
+    return ProbeResult(kind, target, ok, time.monotonic() - probe_start)
+
+
+def ping(target, timeout, cancel=None):
+    return ping_rtt(target, timeout, cancel) is not None
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP_PAYLOAD = b'\xff' * 56  # same as ping -p ff with the default packet size
+
+icmp_socket_type = None  # socket.SOCK_DGRAM, socket.SOCK_RAW or False for the ping binary once detected
+icmp_sequence = itertools.count(1)
+
+
+def ping_rtt(target, timeout, cancel=None):
+    # Returns the round trip time in seconds or None if there was no reply
+    socket_type = detect_icmp_socket_type()
+
+    if not socket_type:
+        return ping_subprocess(target, timeout, cancel)
+
+    return ping_socket(target, timeout, cancel)
+
+
+def detect_icmp_socket_type():
+    global icmp_socket_type
+
+    if icmp_socket_type is None:
+        # Unprivileged ICMP datagram sockets need our group in net.ipv4.ping_group_range
+        # Raw sockets need root or CAP_NET_RAW
+        for socket_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                socket.socket(socket.AF_INET, socket_type, socket.IPPROTO_ICMP).close()
+            except OSError as e:
+                logger.debug(f"ICMP socket type {socket_type!r} unavailable: {e}")
+                continue
+
+            icmp_socket_type = socket_type
+            break
+        else:
+            icmp_socket_type = False
+
+        logger.debug(f"Native ICMP echo using {icmp_socket_type!r}" if icmp_socket_type else 'Native ICMP echo unavailable, using ping binary')
+
+    return icmp_socket_type
+
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+
+    return ~total & 0xffff
+
+
+def build_icmp_echo(identifier, sequence, payload=ICMP_PAYLOAD):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, icmp_checksum(header + payload), identifier, sequence) + payload
+
+
+def parse_icmp_echo_reply(packet, socket_type):
+    # Returns (identifier, sequence) or None if this is not an echo reply
+    if socket_type == socket.SOCK_RAW:
+        # Raw sockets also hand us the IP header
+        packet = packet[(packet[0] & 0x0f) * 4:]
+
+    if len(packet) < 8:
+        return None
+
+    icmp_type, _, _, identifier, sequence = struct.unpack_from('!BBHHH', packet)
+    if icmp_type != ICMP_ECHO_REPLY:
+        return None
+
+    return (identifier, sequence)
+
+
+def open_icmp_socket(socket_type, expected_replies=1):
+    icmp_socket = socket.socket(socket.AF_INET, socket_type, socket.IPPROTO_ICMP)
+    icmp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # same as ping -b
+    # Replies from hundreds of targets arrive in a burst, room is needed for all of them
+    icmp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(64 * 1024, expected_replies * 2048))
+
+    return icmp_socket
+
+
+def receive_icmp_replies(icmp_socket, socket_type, identifier):
+    # Yields (sequence, time received) for every echo reply waiting on the non-blocking socket
+    while True:
+        try:
+            packet, _ = icmp_socket.recvfrom(2048)
+        except BlockingIOError:
+            return
+        received = time.monotonic()
+
+        reply = parse_icmp_echo_reply(packet, socket_type)
+        if reply is None:
+            continue
+        if socket_type == socket.SOCK_RAW and reply[0] != identifier:
+            continue  # raw sockets see every ICMP packet on the host
+
+        yield reply[1], received
+
+
+def ping_socket(target, timeout, cancel=None):
+    return ping_many([target], timeout, cancel).get(target)
+
+
+def ping_many(targets, timeout, cancel=None, on_result=None):
+    # Pings every target from one socket with one shared deadline
+    # Returns {target: round trip time in seconds or None}, on_result(target, rtt) is also called as each one is known
+    results = {}
+
+    def finish(target, rtt):
+        results[target] = rtt
+        if on_result is not None:
+            on_result(target, rtt)
+
+    socket_type = detect_icmp_socket_type()
+
+    if not socket_type:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(targets)), thread_name_prefix='Ping') as executor:
+            futures = {executor.submit(ping_subprocess, target, timeout, cancel): target for target in targets}
+            for future in concurrent.futures.as_completed(futures):
+                finish(futures[future], future.result())
+
+        return results
+
+    deadline = time.monotonic() + timeout
+
+    # The kernel replaces the identifier with the socket's port for datagram sockets and filters replies by it
+    identifier = os.getpid() & 0xffff
+    outstanding = {}  # sequence -> (target, time sent)
+    lookups = {}  # future of socket.getaddrinfo() -> target, for names without a known address
+    resolver = None
+
+    with open_icmp_socket(socket_type, len(targets)) as icmp_socket:
+        icmp_socket.setblocking(False)
+
+        def send(target, address):
+            sequence = next(icmp_sequence) & 0xffff
+
+            try:
+                icmp_socket.sendto(build_icmp_echo(identifier, sequence), (address, 0))
+            except OSError as e:
+                logger.debug(f"Could not send ICMP echo to {target}: {e}")
+                finish(target, None)
+                return
+
+            outstanding[sequence] = (target, time.monotonic())
+
+        # Known addresses go out at once, names are looked up in parallel and pinged as each one resolves so a slow
+        # lookup only uses up its own target's share of the deadline
+        for target in targets:
+            address = known_address(target)
+            if address is not None:
+                send(target, address)
+                continue
+
+            if resolver is None:
+                import concurrent.futures
+                resolver = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='Resolve')
+            lookups[resolver.submit(socket.getaddrinfo, target, None, socket.AF_INET)] = target
+
+        if hasattr(select, 'epoll'):
+            poller = select.epoll(1)
+            poller.register(icmp_socket.fileno(), select.EPOLLIN)
+            wait_readable = poller.poll
+        else:
+            poller = None
+            wait_readable = lambda wait: select.select([icmp_socket], [], [], wait)[0]
+
+        try:
+            while outstanding or lookups:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if cancel is not None and cancel.is_set():
+                    logger.debug(f"Ping of {len(outstanding) + len(lookups)} targets cancelled")
+                    break
+
+                for future in [future for future in lookups if future.done()]:
+                    target = lookups.pop(future)
+                    try:
+                        send(target, future.result()[0][4][0])
+                    except OSError as e:
+                        logger.debug(f"Could not resolve {target}: {e}")
+                        finish(target, None)
+
+                # Lookups have no way to wake the poll so it comes back often while any are running
+                if not wait_readable(min(Config.CANCEL_POLL_INTERVAL, remaining, 0.01 if lookups else remaining)):
+                    continue
+
+                for sequence, received in receive_icmp_replies(icmp_socket, socket_type, identifier):
+                    sent = outstanding.pop(sequence, None)
+                    if sent is not None:
+                        finish(sent[0], received - sent[1])
+        finally:
+            if poller is not None:
+                poller.close()
+            if resolver is not None:
+                # A lookup still running is left to finish in the background
+                resolver.shutdown(wait=False, cancel_futures=True)
+
+    for target in lookups.values():
+        logger.debug(f"Could not resolve {target} within {timeout} seconds")
+        finish(target, None)
+
+    for target, _ in outstanding.values():
+        logger.debug(f"No ICMP echo reply from {target} within {timeout} seconds")
+        finish(target, None)
+
+    return results
+
+
+def known_address(hostname):
+    # The IPv4 address to ping without a lookup, from the address cache or the name itself, otherwise None
+    try:
+        return str(ipaddress.IPv4Address(cached_address(hostname)))
+    except ValueError:
+        return None
+
+
+PING_TIME_PATTERN = re.compile(rb'time[=<]([0-9.]+) ms')
+
+
+def ping_subprocess(target, timeout, cancel=None):
+    # To avoid needing elevated privileges for Python we call the external ping binary instead
+    # This is simpler for the install and usage of the program
+    # Currently only supports POSIX ping command options (no Windows)
+    import subprocess
+
+    started = time.monotonic()
+    process = subprocess.Popen(
+        ['ping', '-b', '-c', '1', '-n', '-p', 'ff', '-W', str(timeout), cached_address(target)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        )
+
+    deadline = time.monotonic() + timeout * 1.25  # Needs to be slightly longer than timeout above for ping command itself
+
+    while True:
+        try:
+            returncode = process.wait(timeout=min(Config.CANCEL_POLL_INTERVAL, max(0, deadline - time.monotonic())))
+        except subprocess.TimeoutExpired as e:
+            if cancel is not None and cancel.is_set():
+                logger.debug(f"Ping of {target} cancelled")
+            elif time.monotonic() >= deadline:
+                # ping command could not complete (possible dns lookup delay of target) in time so return
+                logger.debug(e)
+            else:
+                continue
+
+            process.kill()
+            process.communicate()
+            return None
+
+        elapsed = time.monotonic() - started
+        output = process.communicate()[0]
+
+        if returncode != 0:
+            return None
+
+        match = PING_TIME_PATTERN.search(output)
+        return float(match.group(1)) / 1000 if match else elapsed
+
+
+def website_alive(url, timeout, cancel=None):
+    request_url, headers = pin_url(url)
+
+    if http_probe_pool is not None:
+        result = http_probe_pool.probe(request_url, timeout, cancel, headers)
+        logger.debug(f"website_alive: {result} for {url}")
+        return result.ok
+
+    # If all dns times out it can force retries of dns that take longer than desired timeout
+    # So we have to use a Process inside to enforce request timeout
+    import multiprocessing
+
+    queue = multiprocessing.SimpleQueue()
+    process = multiprocessing.Process(
+        args=(request_url,timeout,queue,headers),
+        name="TimedRequest",
+        target=website_alive_helper
+    )
+
+    process.start()
+
+    deadline = time.monotonic() + timeout
+    while process.is_alive() and time.monotonic() < deadline and not (cancel is not None and cancel.is_set()):
+        process.join(min(Config.CANCEL_POLL_INTERVAL, max(0, deadline - time.monotonic())))
+
+    if process.is_alive():
+        # It is still running in the background unsuccessfully
+        process.terminate()
+        process.join()
+
+        logger.debug(f"Timeout of {timeout} reached for {url}")
+        return False
+
+    response = queue.get()
+    logger.debug(f"website_alive: {response}")
+    # In the event the connection was made but no response do a sanity check
+    return response and response.headers
+
+
+def website_alive_helper(url, timeout, queue, headers=None):
+    session = new_http_session()
+
+    try:
+        response = session.head(url, timeout=timeout, headers=headers)
+    except Exception as e:
+        logger.debug(e)
+        queue.put(False)
+        return
+
+    queue.put(response)
+
+
+def new_http_session():
+    # Disable any retries
+    import requests
+
+    session = requests.sessions.Session()
+    adapter = requests.adapters.HTTPAdapter(max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# Small enough to pickle cheaply between the probe workers and the monitor
+HttpProbeResult = collections.namedtuple('HttpProbeResult', ['ok', 'status', 'elapsed'])
+
+http_probe_pool = None
+
+
+def start_http_probe_pool(size):
+    global http_probe_pool
+
+    http_probe_pool = HttpProbePool(size)
+    http_probe_pool.start()
+
+
+class HttpProbePool():
+    # Long lived sandbox processes for website_alive() so each probe does not pay for a fork
+    # A worker stuck past its deadline is killed and replaced which keeps the hard timeout guarantee
+    def __init__(self, size):
+        self.size = size
+        self.idle = queue.Queue()
+        self.context = None
+
+    def start(self):
+        # Forked off the startup path so the first heartbeat does not wait on it, a deep check that comes before
+        # the workers are ready waits on the idle queue as it would for busy workers
+        threading.Thread(target=self.spawn_workers, name='HttpProbePool', daemon=True).start()
+
+    def spawn_workers(self):
+        import multiprocessing
+
+        # Workers are forked by a single threaded fork server and not from this process, a fork here would copy
+        # whatever lock the log writer or a deep check thread held at that moment into the worker
+        # The server loads nsm and requests once so every worker it forks already has them
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(['__main__', 'requests'])
+
+        for _ in range(self.size):
+            self.idle.put(self.spawn_worker())
+
+        logger.debug(f"Started {self.size} HTTP probe workers")
+
+    def spawn_worker(self):
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            args=(child_connection,),
+            name="HttpProbeWorker",
+            target=http_probe_worker,
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()  # only the worker uses this end
+
+        return (process, parent_connection)
+
+    def replace_worker(self, worker):
+        process, connection = worker
+
+        process.kill()
+        process.join()
+        connection.close()
+
+        # Forking the replacement is done off the probe thread so the deep check is not delayed by it
+        threading.Thread(target=lambda: self.idle.put(self.spawn_worker()), name='HttpProbeRespawn', daemon=True).start()
+
+    def reclaim_worker(self, worker, deadline):
+        # Waits out the request of a cancelled probe, only a worker still busy at the hard deadline is replaced
+        process, connection = worker
+
+        try:
+            if connection.poll(max(0, deadline - time.monotonic())):
+                connection.recv()
+                self.idle.put(worker)
+                return
+        except (EOFError, OSError) as e:
+            logger.debug(f"HTTP probe worker {process.pid} died: {e}")
+
+        self.replace_worker(worker)
+
+    def probe(self, url, timeout, cancel=None, headers=None):
+        probe_start = time.monotonic()
+
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            logger.debug(f"No idle HTTP probe worker for {url} within {timeout} seconds")
+            return HttpProbeResult(False, None, time.monotonic() - probe_start)
+
+        process, connection = worker
+        # Needs to be slightly longer than the worker's own request timeout so only a hung worker is killed
+        deadline = time.monotonic() + timeout * 1.25
+
+        try:
+            connection.send((url, timeout, headers or {}))
+
+            while not connection.poll(min(Config.CANCEL_POLL_INTERVAL, max(0, deadline - time.monotonic()))):
+                if cancel is not None and cancel.is_set():
+                    # The worker is fine, it finishes the request in the background and goes back to idle
+                    logger.debug(f"Web query to {url} cancelled")
+                    threading.Thread(target=self.reclaim_worker, args=(worker, deadline), name='HttpProbeReclaim', daemon=True).start()
+                    return HttpProbeResult(False, None, time.monotonic() - probe_start)
+                if time.monotonic() >= deadline:
+                    logger.debug(f"Timeout of {timeout} reached for {url}")
+                    break
+            else:
+                result = connection.recv()
+                self.idle.put(worker)
+                return result
+        except (EOFError, OSError) as e:
+            logger.debug(f"HTTP probe worker {process.pid} died: {e}")
+
+        # It is still running in the background unsuccessfully or is gone
+        self.replace_worker(worker)
+        return HttpProbeResult(False, None, time.monotonic() - probe_start)
+
+    def close(self):
+        while True:
+            try:
+                process, connection = self.idle.get_nowait()
+            except queue.Empty:
+                return
+
+            connection.close()  # worker exits on EOF
+            process.join(Config.CANCEL_POLL_INTERVAL)
+            if process.is_alive():
+                process.kill()
+
+
+def http_probe_worker(connection):
+    # Runs in the sandbox process for its whole life, one job at a time
+    session = new_http_session()
+
+    while True:
+        try:
+            url, timeout, headers = connection.recv()
+        except EOFError:
+            return
+
+        probe_start = time.monotonic()
+
+        try:
+            # No keep-alive so every probe makes a fresh connection like a one-off request would
+            response = session.head(url, timeout=timeout, headers={'Connection': 'close', **headers})
+        except Exception as e:
+            logger.debug(e)
+            result = HttpProbeResult(False, None, time.monotonic() - probe_start)
+        else:
+            # In the event the connection was made but no response do a sanity check
+            result = HttpProbeResult(bool(response.headers), response.status_code, time.monotonic() - probe_start)
+
+        connection.send(result)
+
+
+address_cache = None
+
+
+def start_address_cache(config):
+    global address_cache
+
+    address_cache = AddressCache(probe_hostnames(config), config.TIMEOUT)
+    address_cache.start()
+
+
+def probe_hostnames(config):
+    # Hostnames of every deep check target, addresses need no lookup
+    hostnames = [target[0] for target in config.ICMP_TARGETS]
+    hostnames += [urllib.parse.urlsplit(url).hostname for url in config.WEB_TARGETS]
+
+    names = []
+    for hostname in hostnames:
+        try:
+            ipaddress.ip_address(hostname)
+        except ValueError:
+            if hostname not in names:
+                names.append(hostname)
+
+    return names
+
+
+def cached_address(hostname):
+    # Probes measure reachability, not how fast a resolver answers, so hand them a literal address when we know one
+    if address_cache is not None:
+        return address_cache.lookup(hostname) or hostname
+
+    return hostname
+
+
+def pin_url(url):
+    # Returns the URL to request and extra headers so the request goes to a cached address for the same virtual host
+    parts = urllib.parse.urlsplit(url)
+    address = cached_address(parts.hostname)
+
+    # https would need the hostname for SNI and certificate checks
+    if parts.scheme != 'http' or address == parts.hostname:
+        return url, {}
+
+    netloc = address if parts.port is None else f"{address}:{parts.port}"
+
+    return urllib.parse.urlunsplit(parts._replace(netloc=netloc)), {'Host': parts.netloc}
+
+
+class AddressCache():
+    # Each hostname is looked up once no matter how many targets use it and again only when its TTL runs out
+    def __init__(self, hostnames, timeout):
+        self.timeout = timeout
+        self.entries = {}  # hostname -> IPv4 address
+        self.refresh_at = {hostname: 0 for hostname in hostnames}  # time.monotonic() of next lookup
+
+    def start(self):
+        if self.refresh_at:
+            threading.Thread(target=self.run, name='AddressCache', daemon=True).start()
+
+    def run(self):
+        while True:
+            for hostname, due in list(self.refresh_at.items()):
+                if due <= time.monotonic():
+                    self.refresh(hostname)
+
+            time.sleep(max(0, min(self.refresh_at.values()) - time.monotonic()))
+
+    def refresh(self, hostname):
+        import dns.exception
+        import dns.rdatatype
+        import dns.resolver
+
+        try:
+            answer = dns.resolver.resolve(hostname, dns.rdatatype.A, lifetime=self.timeout)
+        except dns.exception.DNSException as e:
+            # The last known address is kept, during an outage it is still the best guess to probe
+            logger.debug(f"Could not resolve {hostname} for address cache: {e}")
+            self.refresh_at[hostname] = time.monotonic() + Config.ADDRESS_CACHE_RETRY
+            return
+
+        ttl = max(answer.rrset.ttl, Config.ADDRESS_CACHE_MIN_TTL)
+        address = answer[0].address
+
+        if self.entries.get(hostname) != address:
+            logger.debug(f"Address cache {hostname} is {address} for {ttl} seconds")
+
+        self.entries[hostname] = address
+        self.refresh_at[hostname] = time.monotonic() + ttl
+
+    def lookup(self, hostname):
+        return self.entries.get(hostname)
+
+
+def load_monitored_targets(filepath):
+    with open(filepath, encoding='utf-8') as targets_file:
+        targets = json.load(targets_file)
+
+    for target in targets:
+        if target.get('kind') not in ('icmp', 'web') or not target.get('target'):
+            raise ValueError(f"Monitored target needs kind 'icmp' or 'web' and a target: {target}")
+
+    return targets
+
+
+class MonitoredTarget():
+    __slots__ = ('kind', 'target', 'name', 'interval', 'jitter', 'timeout', 'due', 'scheduled', 'rounds', 'lag', 'in_flight', 'up', 'down_since')
+
+    def __init__(self, settings, config):
+        self.kind = settings['kind']
+        self.target = settings['target']
+        self.name = settings.get('name', self.target)
+        self.interval = float(settings.get('interval', config.TARGET_DEFAULT_INTERVAL))
+        self.jitter = float(settings.get('jitter', config.TARGET_DEFAULT_JITTER))
+        self.timeout = float(settings.get('timeout', config.TIMEOUT))
+        self.due = None  # time.monotonic() the next probe should run
+        self.scheduled = None  # due with jitter applied
+        self.rounds = 0  # full turns of the timing wheel left before it is due
+        self.lag = 0.0  # how late the last probe was handed to a worker
+        self.in_flight = False
+        self.up = None  # unknown until the first probe finishes
+        self.down_since = None
+
+
+class TimingWheel():
+    # Hashed timing wheel, adding an entry and advancing one slot are O(1) no matter how many entries there are
+    # Entries further away than one turn of the wheel wait out whole turns in their slot
+    def __init__(self, tick, slots, start):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.start = start
+        self.current = 0  # ticks since start that have been advanced past
+
+    def add(self, entry, due):
+        ticks = max(self.current, int((due - self.start) / self.tick))
+        entry.rounds = (ticks - self.current) // len(self.slots)
+        self.slots[ticks % len(self.slots)].append(entry)
+
+    def advance(self):
+        # Moves one tick forward and returns the entries that are due
+        slot = self.slots[self.current % len(self.slots)]
+        self.current += 1
+
+        due = []
+        waiting = []
+        for entry in slot:
+            if entry.rounds:
+                entry.rounds -= 1
+                waiting.append(entry)
+            else:
+                due.append(entry)
+        slot[:] = waiting
+
+        return due
+
+    def next_tick_time(self):
+        return self.start + self.current * self.tick
+
+
+class TargetScheduler():
+    # Runs probes of MONITORED_TARGETS on their own intervals from one thread and a bounded pool of workers
+    # ICMP targets due in the same wheel tick share one worker and one socket so unreachable ones do not tie up workers
+    def __init__(self, config, targets):
+        self.config = config
+        self.targets = targets
+        import concurrent.futures
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.TARGET_WORKERS, thread_name_prefix='TargetProbe')
+        self.workers = threading.BoundedSemaphore(config.TARGET_WORKERS)
+        self.wheel = TimingWheel(config.TARGET_WHEEL_TICK, config.TARGET_WHEEL_SLOTS, time.monotonic())
+
+        # Lag is how long after its due time a probe was handed to a worker
+        self.dispatched = 0
+        self.skipped = 0  # due while the previous probe of that target was still running or all workers busy
+        self.lags = []
+        self.max_lag = 0.0
+
+    def start(self):
+        now = time.monotonic()
+        for target in self.targets:
+            # Spread the first probes out over one interval so they do not all go at once
+            target.due = target.scheduled = now + random.uniform(0, target.interval)
+            self.wheel.add(target, target.scheduled)
+
+        threading.Thread(target=self.run, name='TargetScheduler', daemon=True).start()
+        logger.info(f"Watching {len(self.targets)} monitored targets")
+
+    def run(self):
+        report_at = time.monotonic() + self.config.TARGET_REPORT_INTERVAL
+
+        while True:
+            delay = self.wheel.next_tick_time() - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            pings = {}  # timeout -> ICMP targets due this tick
+            for target in self.wheel.advance():
+                self.dispatch(target, pings)
+
+            for timeout, targets in pings.items():
+                self.submit(targets, self.ping, targets, timeout)
+
+            if time.monotonic() >= report_at:
+                self.report()
+                report_at += self.config.TARGET_REPORT_INTERVAL
+
+    def dispatch(self, target, pings):
+        now = time.monotonic()
+        target.lag = max(0.0, now - target.scheduled)
+
+        # Next due time stays on the target's own grid however long this probe takes
+        target.due += target.interval
+        if target.due < now:
+            target.due = now + target.interval
+        target.scheduled = target.due + random.uniform(-target.jitter, target.jitter)
+        self.wheel.add(target, target.scheduled)
+
+        if target.in_flight:
+            self.skipped += 1
+        elif target.kind == 'icmp':
+            pings.setdefault(target.timeout, []).append(target)
+        else:
+            self.submit([target], self.probe, target)
+
+    def submit(self, targets, job, *args):
+        if not self.workers.acquire(blocking=False):
+            self.skipped += len(targets)
+            return
+
+        for target in targets:
+            target.in_flight = True
+            self.dispatched += 1
+            self.lags.append(target.lag)
+            self.max_lag = max(self.max_lag, target.lag)
+
+        try:
+            self.executor.submit(job, *args)
+        except RuntimeError:
+            # Interpreter is shutting down
+            for target in targets:
+                target.in_flight = False
+            self.workers.release()
+
+    def probe(self, target):
+        try:
+            result = run_probe(target.kind, target.target, target.timeout)
+        except Exception as e:
+            logger.debug(e)
+            result = ProbeResult(target.kind, target.target, False, 0.0)
+        finally:
+            target.in_flight = False
+            self.workers.release()
+
+        self.finished(target, result)
+
+    def ping(self, targets, timeout):
+        # run_icmp_batch() takes ICMP targets as (host, name) like Config.ICMP_TARGETS
+        by_probe_target = {}
+        for target in targets:
+            by_probe_target.setdefault((target.target, target.name), []).append(target)
+
+        completed = queue.SimpleQueue()
+        try:
+            run_icmp_batch(completed, list(by_probe_target), timeout)
+        finally:
+            for target in targets:
+                target.in_flight = False
+            self.workers.release()
+
+        while not completed.empty():
+            result = completed.get()
+            for target in by_probe_target[result.target]:
+                self.finished(target, result)
+
+    def finished(self, target, result):
+        if result.ok:
+            record_latency(probe_label(target.kind, target.name), result.latency)
+        rollup_sample(probe_label(target.kind, target.name), result.ok, result.latency)
+
+        if result.ok and target.up is not True:
+            if target.down_since is not None:
+                logger.info(f"Monitored target {target.name} reachable again after {datetime.timedelta(seconds=time.time() - target.down_since)}")
+            target.down_since = None
+        elif not result.ok and target.up is not False:
+            logger.warning(f"Monitored target {target.name} unreachable by {target.kind}")
+            target.down_since = time.time()
+
+        target.up = result.ok
+
+    def report(self):
+        lags = sorted(self.lags)
+        p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0
+
+        logger.info(
+            f"Target scheduler: {self.dispatched} probes dispatched and {self.skipped} skipped in total,"
+            f" lag p99 {p99 * 1000:.1f} ms max {self.max_lag * 1000:.1f} ms,"
+            f" {sum(1 for target in self.targets if target.up is False)} of {len(self.targets)} targets down"
+        )
+
+        self.lags = []
+        self.max_lag = 0.0
+
+
+target_scheduler = None
+
+
+def start_target_monitor(config):
+    global target_scheduler
+
+    if not config.MONITORED_TARGETS:
+        return
+
+    target_scheduler = TargetScheduler(config, [MonitoredTarget(settings, config) for settings in config.MONITORED_TARGETS])
+    target_scheduler.start()
+
+
+# Kinds of records in the time-series store
+TIMESERIES_KIND_DNS = 1  # heartbeat, target is the index into DNS_PAIRS
+TIMESERIES_KIND_ICMP = 2  # target is the index into ICMP_TARGETS
+TIMESERIES_KIND_WEB = 3  # target is the index into WEB_TARGETS
+
+TIMESERIES_RESULT_OK = 0
+TIMESERIES_RESULT_FAILED = 1
+TIMESERIES_NO_RTT = 0xffffffff
+
+# One file per column so a reader can map each one straight into an array
+# name, array typecode, numpy dtype
+TIMESERIES_COLUMNS = [
+    ('mono_us', 'q', '=i8'),  # time.monotonic() in microseconds, comparable within one boot
+    ('wall_ms', 'I', '=u4'),  # milliseconds since midnight UTC of the segment's day
+    ('target', 'H', '=u2'),
+    ('kind', 'B', '=u1'),
+    ('result', 'B', '=u1'),
+    ('rtt_us', 'I', '=u4'),  # TIMESERIES_NO_RTT when there was no answer
+]
+
+
+class MappedColumn():
+    # Append-only file of fixed size values written through a memory map that grows by doubling
+    INITIAL_CAPACITY = 86400  # one day at 1 Hz
+
+    def __init__(self, path, typecode):
+        self.itemsize = array.array(typecode).itemsize
+        self.file = open(path, 'a+b')
+        self.capacity = max(self.INITIAL_CAPACITY, os.fstat(self.file.fileno()).st_size // self.itemsize)
+        self.map = None
+        self.resize(self.capacity)
+
+    def resize(self, capacity):
+        if self.map is not None:
+            self.map.close()
+
+        self.capacity = capacity
+        os.ftruncate(self.file.fileno(), capacity * self.itemsize)
+        self.map = mmap.mmap(self.file.fileno(), capacity * self.itemsize)
+
+    def write(self, index, values):
+        end = index + len(values)
+        if end > self.capacity:
+            self.resize(max(end, self.capacity * 2))
+
+        self.map[index * self.itemsize:end * self.itemsize] = values.tobytes()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class TimeSeriesSegment():
+    # One UTC day of records: a column file each, a count of valid records and meta.json to decode them
+    def __init__(self, path, day, meta):
+        os.makedirs(path, exist_ok=True)
+
+        self.day = day
+        self.midnight = datetime.datetime.combine(day, datetime.time(), tzinfo=datetime.timezone.utc).timestamp()
+
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump(dict(meta, day=day.isoformat(), midnight=self.midnight), meta_file, indent=1)
+
+        # Column files may be longer than the data, count says how much of them is valid
+        count_path = os.path.join(path, 'count')
+        with open(count_path, 'a+b') as count_file:
+            if os.fstat(count_file.fileno()).st_size < 8:
+                count_file.truncate(0)
+                count_file.write(struct.pack('=Q', 0))
+        self.count_file = open(count_path, 'r+b')
+        self.count_map = mmap.mmap(self.count_file.fileno(), 8)
+        self.count = struct.unpack_from('=Q', self.count_map)[0]
+
+        self.columns = [MappedColumn(os.path.join(path, name), typecode) for name, typecode, _ in TIMESERIES_COLUMNS]
+
+    def append(self, rows):
+        # rows is a list of tuples in TIMESERIES_COLUMNS order
+        for column_index, (_, typecode, _) in enumerate(TIMESERIES_COLUMNS):
+            self.columns[column_index].write(self.count, array.array(typecode, [row[column_index] for row in rows]))
+
+        # Data first, count last so a reader never sees records that are not written yet
+        self.count += len(rows)
+        struct.pack_into('=Q', self.count_map, 0, self.count)
+
+    def close(self):
+        for column in self.columns:
+            column.close()
+
+        self.count_map.flush()
+        self.count_map.close()
+        self.count_file.close()
+
+
+class TimeSeriesStore():
+    # Fixed size records of every heartbeat and probe, batched and written into a segment per UTC day
+    def __init__(self, directory, config):
+        self.directory = directory
+        self.batch_size = config.TIMESERIES_BATCH
+        self.meta = {
+            'columns': [[name, dtype] for name, _, dtype in TIMESERIES_COLUMNS],
+            'kinds': {TIMESERIES_KIND_DNS: 'dns', TIMESERIES_KIND_ICMP: 'icmp', TIMESERIES_KIND_WEB: 'web'},
+            'targets': {
+                'dns': [list(dns_pair) for dns_pair in config.DNS_PAIRS],
+                'icmp': [list(target) for target in config.ICMP_TARGETS],
+                'web': list(config.WEB_TARGETS),
+            },
+            'no_rtt': TIMESERIES_NO_RTT,
+        }
+        self.segment = None
+        self.pending = []
+        self.pending_day = None
+        self.lock = threading.Lock()
+
+    def record(self, kind, target, ok, rtt):
+        wall = datetime.datetime.now(datetime.timezone.utc)
+        day = wall.date()
+        mono_us = time.monotonic_ns() // 1000
+        wall_ms = (wall.hour * 3600 + wall.minute * 60 + wall.second) * 1000 + wall.microsecond // 1000
+        rtt_us = min(int(rtt * 1e6), TIMESERIES_NO_RTT - 1) if ok and rtt is not None else TIMESERIES_NO_RTT
+
+        with self.lock:
+            if day != self.pending_day:
+                self.flush_locked()
+                self.pending_day = day
+
+            self.pending.append((mono_us, wall_ms, target, kind, TIMESERIES_RESULT_OK if ok else TIMESERIES_RESULT_FAILED, rtt_us))
+
+            if len(self.pending) >= self.batch_size:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.pending:
+            return
+
+        if self.segment is None or self.segment.day != self.pending_day:
+            if self.segment is not None:
+                self.segment.close()
+            self.segment = TimeSeriesSegment(os.path.join(self.directory, self.pending_day.isoformat()), self.pending_day, self.meta)
+
+        self.segment.append(self.pending)
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self.flush_locked()
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+timeseries_store = None
+
+
+def start_timeseries_store(config):
+    global timeseries_store
+
+    if not config.TIMESERIES_DIR:
+        return
+
+    timeseries_store = TimeSeriesStore(config.TIMESERIES_DIR, config)
+    atexit.register(timeseries_store.close)
+
+
+def record_sample(kind, target, ok, rtt):
+    if outage_checkpoint is not None and kind == TIMESERIES_KIND_DNS:
+        outage_checkpoint.tick(ok)
+
+    if metrics is not None:
+        metrics.sample(kind, target, ok, rtt)
+
+    if rollups is not None:
+        rollups.sample(rollups.labels[kind][target], ok, rtt)
+
+    if latency_histograms is not None and ok:
+        latency_histograms.record(latency_histograms.labels[kind][target], rtt)
+
+    if latency_baselines is not None and ok:
+        latency_baselines.record(latency_baselines.labels[kind][target], rtt)
+
+    if timeseries_store is not None:
+        timeseries_store.record(kind, target, ok, rtt)
+
+
+def record_probe_result(config, result):
+    if timeseries_store is None and latency_histograms is None and latency_baselines is None and metrics is None and rollups is None:
+        return
+
+    if result.kind == 'icmp':
+        record_sample(TIMESERIES_KIND_ICMP, config.ICMP_TARGETS.index(result.target), result.ok, result.latency)
+    else:
+        record_sample(TIMESERIES_KIND_WEB, config.WEB_TARGETS.index(result.target), result.ok, result.latency)
+
+
+def load_timeseries(directory, day):
+    # Returns ({column name: numpy array}, meta) for one day's segment, the arrays are memory maps of the files
+    import numpy  # optional, only needed to read the store
+
+    segment = os.path.join(directory, day if isinstance(day, str) else day.isoformat())
+
+    with open(os.path.join(segment, 'meta.json'), encoding='utf-8') as meta_file:
+        meta = json.load(meta_file)
+
+    with open(os.path.join(segment, 'count'), 'rb') as count_file:
+        count = struct.unpack('=Q', count_file.read(8))[0]
+
+    columns = {}
+    for name, dtype in meta['columns']:
+        columns[name] = numpy.memmap(os.path.join(segment, name), dtype=dtype, mode='r', shape=(count,)) if count else numpy.empty(0, dtype=dtype)
+
+    return columns, meta
+
+
+class LatencyHistogram():
+    # HDR style histogram of microseconds, values below 2**bits get a bucket each and every power of two above
+    # that is split into 2**bits linear buckets so the relative error stays the same at any latency
+    # Buckets are kept sparse, a minute of one target's samples only touches a few dozen of the hundreds there are
+    MAX_MICROSECONDS = 1 << 27  # about 134 seconds, anything slower is counted in the last bucket
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.sub_buckets = 1 << bits
+        self.counts = {}  # bucket index: count
+        self.total = 0
+        self.max = 0
+
+    def bucket_index(self, microseconds):
+        if microseconds < self.sub_buckets:
+            return microseconds
+
+        shift = microseconds.bit_length() - 1 - self.bits
+        return (shift + 1) * self.sub_buckets + (microseconds >> shift) - self.sub_buckets
+
+    def bucket_range(self, index):
+        # Lowest and highest microseconds counted in the bucket
+        if index < self.sub_buckets:
+            return index, index
+
+        shift = index // self.sub_buckets - 1
+        mantissa = index % self.sub_buckets + self.sub_buckets
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        microseconds = min(max(0, int(seconds * 1e6)), self.MAX_MICROSECONDS - 1)
+        index = self.bucket_index(microseconds)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.max = max(self.max, microseconds)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, fraction):
+        # Seconds at or below which fraction of the samples fall, the middle of the bucket that holds that sample
+        if not self.total:
+            return None
+
+        rank = max(1, math.ceil(fraction * self.total))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                low, high = self.bucket_range(index)
+                return min((low + high) / 2, self.max) / 1e6
+
+        return self.max / 1e6
+
+
+class LatencyHistograms():
+    # One LatencyHistogram per target per minute for the last LATENCY_HISTOGRAM_MINUTES, older minutes are dropped
+    def __init__(self, config):
+        self.bits = config.LATENCY_SUB_BUCKET_BITS
+        self.minutes = config.LATENCY_HISTOGRAM_MINUTES
+        self.report_interval = config.LATENCY_REPORT_INTERVAL
+        self.report_at = time.monotonic() + self.report_interval if self.report_interval else None
+        self.histograms = {}  # label: deque of (minute, LatencyHistogram)
+        self.lock = threading.Lock()
+
+        self.labels = probe_labels(config)
+
+    def record(self, label, rtt):
+        minute = int(time.time() // 60)
+
+        with self.lock:
+            ring = self.histograms.get(label)
+            if ring is None:
+                ring = self.histograms[label] = collections.deque(maxlen=self.minutes)
+            if not ring or ring[-1][0] != minute:
+                ring.append((minute, LatencyHistogram(self.bits)))
+            ring[-1][1].record(rtt)
+
+        if self.report_at is not None and time.monotonic() >= self.report_at:
+            self.report_at += self.report_interval
+            self.report()
+
+    def merged(self, label, since=None, until=None):
+        # One histogram of the minutes from time.time() since up to until for a label
+        histogram = LatencyHistogram(self.bits)
+
+        with self.lock:
+            for minute, minute_histogram in self.histograms.get(label, ()):
+                if (since is None or minute * 60 >= since - since % 60) and (until is None or minute * 60 < until):
+                    histogram.merge(minute_histogram)
+
+        return histogram
+
+    def report(self):
+        window = min(self.report_interval, self.minutes * 60)
+        since = time.time() - window
+
+        with self.lock:
+            labels = list(self.histograms)
+
+        for label in labels:
+            histogram = self.merged(label, since)
+            if histogram.total:
+                p50, p99, p999 = (histogram.quantile(fraction) * 1000 for fraction in (0.5, 0.99, 0.999))
+                logger.info(
+                    f"Latency of {label} over the last {datetime.timedelta(seconds=window)}: p50 {p50:.1f} ms p99 {p99:.1f} ms"
+                    f" p99.9 {p999:.1f} ms max {histogram.max / 1000:.1f} ms ({histogram.total} samples)"
+                )
+
+
+def probe_label(kind, target):
+    # ICMP targets and DNS pairs are (address, name), name the target by its address like the log does
+    return f"{kind} {target[0] if isinstance(target, tuple) else target}"
+
+
+def probe_labels(config):
+    # Labels by the kind and index record_sample() is called with, the same ones the time-series store uses
+    return {
+        TIMESERIES_KIND_DNS: [probe_label('dns', dns_pair) for dns_pair in config.DNS_PAIRS],
+        TIMESERIES_KIND_ICMP: [probe_label('icmp', target) for target in config.ICMP_TARGETS],
+        TIMESERIES_KIND_WEB: [probe_label('web', target) for target in config.WEB_TARGETS],
+    }
+
+
+latency_histograms = None
+
+
+def start_latency_histograms(config):
+    global latency_histograms
+
+    if not config.LATENCY_HISTOGRAM_MINUTES:
+        return
+
+    latency_histograms = LatencyHistograms(config)
+
+
+def record_latency(label, rtt):
+    if metrics is not None:
+        kind, target = label.split(' ', 1)
+        metrics.observe('nsm_probe_latency_seconds', rtt, (('kind', kind), ('target', target)))
+
+    if latency_histograms is not None:
+        latency_histograms.record(label, rtt)
+
+    if latency_baselines is not None:
+        latency_baselines.record(label, rtt)
+
+
+class QuantileSketch():
+    # DDSketch style, bucket i counts the values in (gamma**(i-1), gamma**i] so every quantile is within the relative
+    # accuracy of the true value, adding is O(1) and two sketches merge by adding their buckets
+    def __init__(self, gamma, max_buckets):
+        self.gamma = gamma
+        self.log_gamma = math.log(gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.count = 0
+
+    @classmethod
+    def for_accuracy(cls, accuracy, max_buckets):
+        # accuracy is the relative error allowed on any quantile, 0.02 for 2%
+        return cls((1 + accuracy) / (1 - accuracy), max_buckets)
+
+    def add(self, value):
+        self.add_index(math.ceil(math.log(max(value, 1e-6)) / self.log_gamma))
+
+    def add_index(self, index, count=1):
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        # Fold the lowest bucket into the next one, only the lowest quantiles lose accuracy
+        lowest = min(self.buckets)
+        count = self.buckets.pop(lowest)
+        following = min(self.buckets)
+        self.buckets[following] += count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.add_index(index, count)
+
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+
+        rank = fraction * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class LatencyBaselines():
+    # Rolling latency quantiles per target, each window is a ring of sketches one granularity long so the oldest
+    # falls off as time moves on, a window covers between span and span plus one granularity of samples
+    WINDOWS = [  # name, span, granularity in seconds
+        ('5m', 300, 60),
+        ('1h', 3600, 300),
+        ('24h', 86400, 3600),
+    ]
+    THRESHOLD_REFRESH = 60  # seconds an anomaly threshold is reused before the 1 hour sketches are merged again
+
+    def __init__(self, config):
+        self.accuracy = config.LATENCY_SKETCH_ACCURACY
+        self.max_buckets = config.LATENCY_SKETCH_MAX_BUCKETS
+        self.anomaly_factor = config.LATENCY_ANOMALY_FACTOR
+        self.anomaly_min_samples = config.LATENCY_ANOMALY_MIN_SAMPLES
+        self.labels = probe_labels(config)
+        self.rings = {}  # label: [deque of (slot, QuantileSketch) per window]
+        self.thresholds = {}  # label: (time.monotonic() to refresh at, slowest normal latency or None)
+        self.lock = threading.Lock()
+
+    def record(self, label, rtt):
+        now = time.time()
+
+        with self.lock:
+            rings = self.rings.get(label)
+            if rings is None:
+                rings = self.rings[label] = [collections.deque(maxlen=span // granularity + 1) for _, span, granularity in self.WINDOWS]
+
+            for (_, _, granularity), ring in zip(self.WINDOWS, rings):
+                slot = int(now // granularity)
+                if not ring or ring[-1][0] != slot:
+                    ring.append((slot, QuantileSketch.for_accuracy(self.accuracy, self.max_buckets)))
+                ring[-1][1].add(rtt)
+
+    def window(self, label, name):
+        # One sketch of the samples in the named window
+        position, (_, span, granularity) = next((position, window) for position, window in enumerate(self.WINDOWS) if window[0] == name)
+        oldest_slot = int((time.time() - span) // granularity)
+        sketch = QuantileSketch.for_accuracy(self.accuracy, self.max_buckets)
+
+        with self.lock:
+            for slot, slot_sketch in self.rings.get(label, [()] * len(self.WINDOWS))[position]:
+                if slot >= oldest_slot:
+                    sketch.merge(slot_sketch)
+
+        return sketch
+
+    def snapshot(self):
+        # {label: {window: (samples, p50, p95)}} in seconds, built from the sketches alone
+        with self.lock:
+            labels = list(self.rings)
+
+        snapshot = {}
+        for label in labels:
+            snapshot[label] = {}
+            for name, _, _ in self.WINDOWS:
+                sketch = self.window(label, name)
+                snapshot[label][name] = (sketch.count, sketch.quantile(0.5), sketch.quantile(0.95))
+
+        return snapshot
+
+    def is_anomaly(self, label, rtt):
+        now = time.monotonic()
+        refresh_at, threshold = self.thresholds.get(label, (0, None))
+
+        if now >= refresh_at:
+            sketch = self.window(label, '1h')
+            threshold = sketch.quantile(0.95) if sketch.count >= self.anomaly_min_samples else None
+            self.thresholds[label] = (now + self.THRESHOLD_REFRESH, threshold)
+
+        if threshold is None or rtt <= threshold * self.anomaly_factor:
+            return False
+
+        logger.info(f"Slow answer from {label}: {rtt * 1000:.1f} ms against a 1 hour p95 of {threshold * 1000:.1f} ms")
+        return True
+
+
+latency_baselines = None
+
+
+def start_latency_baselines(config):
+    global latency_baselines
+
+    if not config.LATENCY_BASELINES:
+        return
+
+    latency_baselines = LatencyBaselines(config)
+
+
+def is_latency_anomaly(kind, target, rtt):
+    if latency_baselines is None or latency_baselines.anomaly_factor is None:
+        return False
+
+    return latency_baselines.is_anomaly(latency_baselines.labels[kind][target], rtt)
+
+
+# name, type, help
+METRIC_FAMILIES = [
+    ('nsm_heartbeats_total', 'counter', 'Heartbeat DNS queries by resolver and result'),
+    ('nsm_heartbeat_hedges_total', 'counter', 'Heartbeats that also asked other resolvers because the first was slow'),
+    ('nsm_deep_checks_total', 'counter', 'Deep checks run after a failed heartbeat'),
+    ('nsm_false_alarms_total', 'counter', 'Deep checks that found the network up'),
+    ('nsm_outages_total', 'counter', 'Outages detected'),
+    ('nsm_outage_start_timestamp_seconds', 'gauge', 'Unix time the current outage was detected, 0 when there is none'),
+    ('nsm_probe_latency_seconds', 'histogram', 'Round trip time of successful heartbeats and probes'),
+    ('nsm_scheduler_lag_seconds', 'gauge', 'How late the last heartbeat tick started'),
+    ('nsm_scheduler_missed_ticks_total', 'counter', 'Heartbeat ticks missed because a check overran the interval'),
+    ('nsm_scheduler_blind_seconds_total', 'counter', 'Seconds no heartbeat ran because of missed ticks'),
+    ('nsm_log_records_dropped_total', 'counter', 'DEBUG log records dropped because the log queue was full'),
+]
+
+
+class MetricFamily():
+    __slots__ = ('name', 'type', 'help', 'values', 'text')
+
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.values = {}  # label pairs: value, or [bucket counts, sum, count] for a histogram
+        self.text = None  # exposition of this family, None after a change until it is rendered again
+
+
+class Metrics():
+    # Counters, gauges and histograms in the Prometheus text format, each family is rendered again only after it
+    # changed and the joined exposition is reused as it is while nothing changed between scrapes
+    def __init__(self, config):
+        self.families = {name: MetricFamily(name, metric_type, help_text) for name, metric_type, help_text in METRIC_FAMILIES}
+        self.buckets = config.METRICS_LATENCY_BUCKETS
+        self.exposition_text = None
+        self.lock = threading.Lock()
+
+        # record_sample() passes the kind and index used by the time-series store
+        self.labels = {
+            kind: [(('kind', label.split(' ', 1)[0]), ('target', label.split(' ', 1)[1])) for label in labels]
+            for kind, labels in probe_labels(config).items()
+        }
+
+        # Families with no labels start at 0 so they show up before the first event
+        for family in self.families.values():
+            if family.type != 'histogram' and family.name not in ('nsm_heartbeats_total', 'nsm_scheduler_lag_seconds'):
+                family.values[()] = 0
+
+    def changed(self, family):
+        family.text = None
+        self.exposition_text = None
+
+    def inc(self, name, labels=(), value=1):
+        family = self.families[name]
+        with self.lock:
+            family.values[labels] = family.values.get(labels, 0) + value
+            self.changed(family)
+
+    def set(self, name, value, labels=()):
+        family = self.families[name]
+        with self.lock:
+            family.values[labels] = value
+            self.changed(family)
+
+    def observe(self, name, value, labels=()):
+        family = self.families[name]
+        with self.lock:
+            histogram = family.values.get(labels)
+            if histogram is None:
+                histogram = family.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            self.changed(family)
+
+    def sample(self, kind, target, ok, rtt):
+        labels = self.labels[kind][target]
+
+        if kind == TIMESERIES_KIND_DNS:
+            self.inc('nsm_heartbeats_total', (('resolver', labels[1][1]), ('result', 'success' if ok else 'failure')))
+        if ok:
+            self.observe('nsm_probe_latency_seconds', rtt, labels)
+
+    def render(self, family):
+        lines = [f"# HELP {family.name} {family.help}", f"# TYPE {family.name} {family.type}"]
+
+        for labels, value in sorted(family.values.items()):
+            if family.type != 'histogram':
+                lines.append(f"{family.name}{metric_labels(labels)} {value}")
+                continue
+
+            bucket_counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{family.name}_bucket{metric_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{family.name}_sum{metric_labels(labels)} {total}")
+            lines.append(f"{family.name}_count{metric_labels(labels)} {count}")
+
+        return '\n'.join(lines) + '\n'
+
+    def exposition(self):
+        with self.lock:
+            if self.exposition_text is None:
+                for family in self.families.values():
+                    if family.text is None:
+                        family.text = self.render(family)
+                self.exposition_text = ''.join(family.text for family in self.families.values())
+
+            text = self.exposition_text
+            outage_start = self.families['nsm_outage_start_timestamp_seconds'].values[()]
+
+        # The only value that changes on its own, so it is added at scrape time instead of being cached
+        outage_age = time.time() - outage_start if outage_start else 0
+        return (
+            text +
+            '# HELP nsm_current_outage_seconds Age of the current outage, 0 when there is none\n'
+            '# TYPE nsm_current_outage_seconds gauge\n'
+            f"nsm_current_outage_seconds {outage_age}\n"
+        )
+
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f"{key}=\"{metric_label_value(value)}\"" for key, value in labels) + '}'
+
+
+def metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = None
+
+
+def start_metrics_server(config):
+    global metrics
+
+    if not config.METRICS_LISTEN:
+        return
+
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = metrics.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+    address, _, port = str(config.METRICS_LISTEN).rpartition(':')
+    metrics = Metrics(config)
+
+    server = http.server.ThreadingHTTPServer((address or '127.0.0.1', int(port)), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    logger.info(f"Serving metrics on http://{address or '127.0.0.1'}:{port}/metrics")
+
+
+def metric_inc(name, labels=(), value=1):
+    if metrics is not None:
+        metrics.inc(name, labels, value)
+
+
+def metric_set(name, value, labels=()):
+    if metrics is not None:
+        metrics.set(name, value, labels)
+
+
+JOURNAL_OUTAGE = 'outage'
+JOURNAL_MICRO_OUTAGE = 'micro'
+JOURNAL_FALSE_ALARM = 'false_alarm'
+
+JOURNAL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outages (
+    id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,  -- time.time() the outage was detected
+    end REAL,  -- NULL while the outage is ongoing
+    duration REAL,
+    classification TEXT NOT NULL,
+    failing_targets TEXT NOT NULL  -- JSON list of "kind target"
+);
+CREATE INDEX IF NOT EXISTS outages_start ON outages (start);
+'''
+
+
+class SqliteWriter():
+    # Statements go through a queue to one writer thread which commits whatever arrived together in one transaction
+    STOP = object()
+
+    def __init__(self, path, schema, commit_delay, name):
+        self.path = path
+        self.commit_delay = commit_delay
+        self.name = name
+        self.statements = queue.Queue()
+        self.thread = None
+
+        # Create the schema up front so a bad path fails at startup instead of in the writer
+        connection = self.connect()
+        connection.executescript(schema)
+        connection.close()
+
+    def connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')  # durable at each WAL checkpoint, safe against corruption
+        return connection
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def execute(self, statement, parameters):
+        self.statements.put((statement, parameters))
+
+    def run(self):
+        import sqlite3
+
+        connection = self.connect()
+        stopping = False
+
+        while not stopping:
+            batch = [self.statements.get()]
+            deadline = time.monotonic() + self.commit_delay
+            while batch[-1] is not self.STOP:
+                try:
+                    batch.append(self.statements.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is self.STOP
+            if stopping:
+                batch.pop()
+
+            try:
+                with connection:
+                    for statement, parameters in batch:
+                        connection.execute(statement, parameters)
+            except sqlite3.Error as e:
+                logger.error(f"{self.name} could not write {len(batch)} records: {e}")
+
+        connection.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.statements.put(self.STOP)
+            self.thread.join(timeout=5)
+
+
+class OutageJournal(SqliteWriter):
+    def __init__(self, path, commit_delay):
+        super().__init__(path, JOURNAL_SCHEMA, commit_delay, 'OutageJournal')
+
+    def started(self, start, failures):
+        self.execute(
+            'INSERT INTO outages (start, classification, failing_targets) VALUES (?, ?, ?)',
+            (start, JOURNAL_OUTAGE, journal_failing_targets(failures)),
+        )
+
+    def ended(self, start, end):
+        self.execute(
+            'UPDATE outages SET end = ?, duration = ? - start WHERE start = ? AND end IS NULL',
+            (end, end, start),
+        )
+
+    def record(self, classification, start, end, failures):
+        self.execute(
+            'INSERT INTO outages (start, end, duration, classification, failing_targets) VALUES (?, ?, ?, ?, ?)',
+            (start, end, end - start, classification, journal_failing_targets(failures)),
+        )
+
+
+def journal_failing_targets(failures):
+    return json.dumps([probe_label(probe.kind, probe.target) for probe in failures])
+
+
+outage_journal = None
+
+
+def start_outage_journal(config):
+    global outage_journal
+
+    if not config.OUTAGE_JOURNAL:
+        return
+
+    outage_journal = OutageJournal(config.OUTAGE_JOURNAL, config.JOURNAL_COMMIT_DELAY)
+    outage_journal.start()
+    atexit.register(outage_journal.close)
+
+
+def journal_outage_started(start, failures):
+    if outage_journal is not None:
+        outage_journal.started(start, failures)
+
+
+def journal_outage_ended(start, end):
+    if outage_journal is not None:
+        outage_journal.ended(start, end)
+
+
+def journal_record(classification, start, end, failures):
+    if outage_journal is not None:
+        outage_journal.record(classification, start, end, failures)
+
+
+# sequence, start_of_failure (0 for none), last_success (0 for none), time.time() of the last heartbeat then the CRC32
+CHECKPOINT_FORMAT = struct.Struct('<Qddd')
+CHECKPOINT_CRC = struct.Struct('<I')
+
+
+class OutageCheckpoint():
+    # Two slots a page apart written in turn and synced with msync, a crash mid write can only tear the slot being
+    # written and its CRC no longer matches so the other slot, one heartbeat older, is used instead
+    # Heartbeats only write the mapping and sync at most every sync_interval, the page cache survives a crash of
+    # the monitor itself so only a power cut loses the heartbeats since the last sync
+    SLOT_SIZE = mmap.PAGESIZE
+
+    def __init__(self, path, max_gap, sync_interval=1.0):
+        self.max_gap = max_gap
+        self.sync_interval = sync_interval
+        self.synced_at = None  # time.monotonic() of the last msync
+        self.lock = threading.Lock()
+
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(descriptor).st_size < 2 * self.SLOT_SIZE:
+                os.ftruncate(descriptor, 2 * self.SLOT_SIZE)
+            self.map = mmap.mmap(descriptor, 2 * self.SLOT_SIZE)
+        finally:
+            os.close(descriptor)
+
+        self.sequence, self.start_of_failure, self.last_success, self.last_tick = self.read()
+
+    def read(self):
+        # Newest slot with a good CRC, all zeros when there is none
+        newest = (0, 0.0, 0.0, 0.0)
+
+        for slot in range(2):
+            offset = slot * self.SLOT_SIZE
+            data = self.map[offset:offset + CHECKPOINT_FORMAT.size]
+            crc, = CHECKPOINT_CRC.unpack_from(self.map, offset + CHECKPOINT_FORMAT.size)
+            values = CHECKPOINT_FORMAT.unpack(data)
+
+            if values[0] and zlib.crc32(data) == crc and values[0] > newest[0]:
+                newest = values
+
+        return newest
+
+    def write(self, sync=True):
+        self.sequence += 1
+        offset = (self.sequence % 2) * self.SLOT_SIZE
+        data = CHECKPOINT_FORMAT.pack(self.sequence, self.start_of_failure, self.last_success, self.last_tick)
+
+        self.map[offset:offset + CHECKPOINT_FORMAT.size + CHECKPOINT_CRC.size] = data + CHECKPOINT_CRC.pack(zlib.crc32(data))
+
+        now = time.monotonic()
+        if sync or self.synced_at is None or now - self.synced_at >= self.sync_interval:
+            self.map.flush()  # both slots, the other one may hold a heartbeat not synced yet
+            self.synced_at = now
+
+    def tick(self, ok):
+        # Every heartbeat, outage start and end are saved by save() as they happen
+        with self.lock:
+            self.last_tick = time.time()
+            if ok:
+                self.last_success = self.last_tick
+            self.write(sync=False)
+
+    def save(self, start_of_failure, last_success):
+        with self.lock:
+            self.start_of_failure = start_of_failure or 0.0
+            self.last_success = last_success or 0.0
+            self.last_tick = time.time()
+            self.write()
+
+    def restore(self, tracker):
+        tracker.last_success = self.last_success or None
+
+        if not self.start_of_failure:
+            return
+
+        started = datetime.datetime.fromtimestamp(self.start_of_failure).isoformat(sep=' ', timespec='seconds')
+        gap = time.time() - self.last_tick
+
+        if gap <= self.max_gap:
+            logger.warning(f"Resuming outage detected at {started} from the checkpoint, the monitor was not running for {datetime.timedelta(seconds=round(gap))}")
+            tracker.start_of_failure = self.start_of_failure
+            # The run that stopped wrote its rollups up to about its last heartbeat, count on from there
+            rollup_outage_started(max(self.start_of_failure, self.last_tick))
+            metric_inc('nsm_outages_total')
+            metric_set('nsm_outage_start_timestamp_seconds', self.start_of_failure)
+        else:
+            # Too long ago to say what happened since, close it at the last heartbeat that saw it
+            stopped = datetime.datetime.fromtimestamp(self.last_tick).isoformat(sep=' ', timespec='seconds')
+            logger.warning(f"Outage detected at {started} was still going on when the monitor stopped at {stopped}, not resuming it")
+            journal_outage_ended(self.start_of_failure, self.last_tick)
+            self.save(None, self.last_success)
+
+
+outage_checkpoint = None
+
+
+def start_outage_checkpoint(config):
+    global outage_checkpoint
+
+    if not config.OUTAGE_CHECKPOINT:
+        return
+
+    outage_checkpoint = OutageCheckpoint(config.OUTAGE_CHECKPOINT, config.CHECKPOINT_MAX_GAP, config.CHECKPOINT_SYNC_INTERVAL)
+
+
+def checkpoint_outage_state(start_of_failure, last_success):
+    if outage_checkpoint is not None:
+        outage_checkpoint.save(start_of_failure, last_success)
+
+
+ROLLUP_LEVELS = [('1m', 60), ('1h', 3600), ('1d', 86400)]  # periods are aligned to UTC
+ROLLUP_NETWORK = 'network'  # target of the rows with every heartbeat and the outage seconds
+
+ROLLUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollups (
+    level TEXT NOT NULL,
+    start INTEGER NOT NULL,  -- unix time the period starts
+    target TEXT NOT NULL,  -- 'network' or "kind target"
+    successes INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    outage_seconds REAL NOT NULL,
+    latency_count INTEGER NOT NULL,
+    latency_sum REAL NOT NULL,
+    latency_min REAL,
+    latency_max REAL,
+    latency_p50 REAL,
+    latency_p95 REAL,
+    PRIMARY KEY (level, target, start)
+) WITHOUT ROWID;
+'''
+
+# A period written twice, e.g. partly before and partly after a restart, is added together
+ROLLUP_UPSERT = '''
+INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (level, target, start) DO UPDATE SET
+    successes = successes + excluded.successes,
+    failures = failures + excluded.failures,
+    outage_seconds = outage_seconds + excluded.outage_seconds,
+    latency_p50 = CASE WHEN excluded.latency_count > latency_count THEN excluded.latency_p50 ELSE latency_p50 END,
+    latency_p95 = CASE WHEN excluded.latency_count > latency_count THEN excluded.latency_p95 ELSE latency_p95 END,
+    latency_count = latency_count + excluded.latency_count,
+    latency_sum = latency_sum + excluded.latency_sum,
+    latency_min = min(coalesce(latency_min, excluded.latency_min), coalesce(excluded.latency_min, latency_min)),
+    latency_max = max(coalesce(latency_max, excluded.latency_max), coalesce(excluded.latency_max, latency_max))
+'''
+
+
+class RollupPeriod():
+    __slots__ = ('start', 'successes', 'failures', 'outage_seconds', 'latency_sum', 'latency_min', 'latency_max', 'sketch')
+
+    def __init__(self, start, sketch):
+        self.start = start
+        self.successes = 0
+        self.failures = 0
+        self.outage_seconds = 0.0
+        self.latency_sum = 0.0
+        self.latency_min = None
+        self.latency_max = None
+        self.sketch = sketch
+
+
+class RollupEngine(SqliteWriter):
+    # Every sample updates the open period of each level for its target, a period is written once a sample for a
+    # later one arrives so a one year view at the 1d level reads 365 rows
+    def __init__(self, config):
+        super().__init__(config.ROLLUP_DB, ROLLUP_SCHEMA, config.JOURNAL_COMMIT_DELAY, 'RollupEngine')
+
+        self.labels = probe_labels(config)
+        self.retention = config.ROLLUP_RETENTION
+        self.accuracy = config.LATENCY_SKETCH_ACCURACY
+        self.max_buckets = config.LATENCY_SKETCH_MAX_BUCKETS
+        self.periods = {}  # (level, target): RollupPeriod still open
+        self.outage_start = None
+        self.lock = threading.Lock()
+
+    def sample(self, target, ok, rtt):
+        now = time.time()
+
+        with self.lock:
+            for level, seconds in ROLLUP_LEVELS:
+                self.add(self.period(level, seconds, target, now), ok, rtt)
+                if target.startswith('dns '):
+                    self.add(self.period(level, seconds, ROLLUP_NETWORK, now), ok, rtt)
+
+    def add(self, period, ok, rtt):
+        if not ok:
+            period.failures += 1
+            return
+
+        period.successes += 1
+        period.latency_sum += rtt
+        period.latency_min = rtt if period.latency_min is None else min(period.latency_min, rtt)
+        period.latency_max = rtt if period.latency_max is None else max(period.latency_max, rtt)
+        period.sketch.add(rtt)
+
+    def period(self, level, seconds, target, now):
+        start = int(now - now % seconds)
+        period = self.periods.get((level, target))
+
+        if period is None or period.start != start:
+            if period is not None:
+                self.write(level, seconds, target, period)
+            period = self.periods[level, target] = RollupPeriod(start, QuantileSketch.for_accuracy(self.accuracy, self.max_buckets))
+
+        return period
+
+    def write(self, level, seconds, target, period, end=None):
+        end = period.start + seconds if end is None else end
+
+        if target == ROLLUP_NETWORK and self.outage_start is not None:
+            # The outage is still going on so the rest of this period counts
+            period.outage_seconds += max(0.0, end - max(self.outage_start, period.start))
+
+        # Sketch quantiles are the middle of a bucket, keep them within what was actually seen
+        p50, p95 = (
+            None if quantile is None else min(max(quantile, period.latency_min), period.latency_max)
+            for quantile in (period.sketch.quantile(0.5), period.sketch.quantile(0.95))
+        )
+
+        self.execute(ROLLUP_UPSERT, (
+            level, period.start, target, period.successes, period.failures, period.outage_seconds,
+            period.sketch.count, period.latency_sum, period.latency_min, period.latency_max, p50, p95,
+        ))
+
+        if target == ROLLUP_NETWORK and self.retention.get(level):
+            self.execute('DELETE FROM rollups WHERE level = ? AND start < ?', (level, period.start - self.retention[level]))
+
+    def outage_started(self, start):
+        with self.lock:
+            self.outage_start = start
+
+    def outage_ended(self, start, end):
+        # Periods written while the outage was on already counted it up to their end, this period counts from its start
+        # An outage resumed from the checkpoint was counted by the previous run up to when it stopped
+        with self.lock:
+            counted_from = start if self.outage_start is None else self.outage_start
+            for level, seconds in ROLLUP_LEVELS:
+                period = self.period(level, seconds, ROLLUP_NETWORK, end)
+                period.outage_seconds += max(0.0, end - max(counted_from, period.start))
+            self.outage_start = None
+
+    def close(self):
+        # Write the periods still open, the next run adds to them if it starts within the same period
+        now = time.time()
+        with self.lock:
+            for (level, target), period in self.periods.items():
+                self.write(level, dict(ROLLUP_LEVELS)[level], target, period, end=min(now, period.start + dict(ROLLUP_LEVELS)[level]))
+            self.periods = {}
+
+        super().close()
+
+
+rollups = None
+
+
+def start_rollups(config):
+    global rollups
+
+    if not config.ROLLUP_DB:
+        return
+
+    rollups = RollupEngine(config)
+    rollups.start()
+    atexit.register(rollups.close)
+
+
+def rollup_sample(target, ok, rtt):
+    if rollups is not None:
+        rollups.sample(target, ok, rtt)
+
+
+def rollup_outage_started(start):
+    if rollups is not None:
+        rollups.outage_started(start)
+
+
+def rollup_outage_ended(start, end):
+    if rollups is not None:
+        rollups.outage_ended(start, end)
+
+
+async def async_main(config):
+    # Heartbeat, deep checks and reporting all share this one event loop so none of them block the others
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    start_address_cache(config)
+    start_async_pinger(config)
+    start_target_monitor(config)
+    tracker = OutageTracker()
+    deep_check_task = None
+    scheduler = FixedRateScheduler(config.MONITORING_INTERVAL, config.OVERRUN_POLICY)
+
+    for pair_index, dns_pair in itertools.cycle(enumerate(config.DNS_PAIRS)):
+        await asyncio.sleep(scheduler.delay())
+        scheduler.tick_started()
+        loop_start = loop.time()
+
+        logger.debug(f"Interval check using {dns_pair}")
+
+        answer = await async_resolve(dns_pair, config.TIMEOUT)
+        record_sample(TIMESERIES_KIND_DNS, pair_index, bool(answer), loop.time() - loop_start)
+        if answer:
+            is_latency_anomaly(TIMESERIES_KIND_DNS, pair_index, loop.time() - loop_start)
+
+        if not answer:
+            if deep_check_task is not None and not deep_check_task.done():
+                logger.warning(f"Failed to resolve using {dns_pair}. Deep check already running")
+            else:
+                logger.warning(f"Failed to resolve using {dns_pair}. Network may be down, kicking off deep check")
+                deep_check_task = asyncio.create_task(async_deep_check_and_record(config, tracker))
+        else:
+            tracker.heartbeat_passed()
+            logger.debug(f"Network connection test passed with DNS pair {dns_pair} answering " + "\t".join(str(x) for x in answer))
+
+        time_taken = loop.time() - loop_start
+        logger.debug(f"It took {time_taken} seconds to complete the last interval check")
+
+
+async def async_resolve(dns_pair, timeout):
+    import dns.asyncresolver
+    import dns.rdatatype
+    import dns.resolver
+
+    dns_client = dns.asyncresolver.Resolver(configure=False)
+    dns_client.nameservers=[dns_pair[0]]
+    dns_client.timeout=timeout
+    dns_client.lifetime=timeout
+    dns_client.cache=None
+    dns_client.retry_servfail=False
+
+    try:
+        return await dns_client.resolve(
+            qname=dns_pair[1],
+            rdtype=dns.rdatatype.A,
+            tcp=False  # UDP
+            )
+    except (dns.resolver.LifetimeTimeout, dns.resolver.NoNameservers) as e:
+        logger.debug(e)
+        return None
+
+
+async def async_deep_check_and_record(config, tracker):
+    deep_check_started = time.time()
+    tracker.deep_check_finished(await async_deep_check(config), deep_check_started)
+
+
+async def async_deep_check(config):
+    # Same verdict as deep_check() but every probe is a task on the event loop instead of a thread or process
+    import asyncio
+
+    check_start = time.monotonic()
+
+    probes = [('icmp', target) for target in config.ICMP_TARGETS] + [('web', target) for target in config.WEB_TARGETS]
+    number_total_checks_made = len(probes)
+    results = []
+
+    quorum = QuorumEvaluator(number_total_checks_made, config.OUTAGE_THRESHOLD)
+    verdict = quorum.verdict()
+
+    pending = {asyncio.create_task(async_run_probe(kind, target, config.TIMEOUT)) for kind, target in probes}
+
+    try:
+        while pending and verdict is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                result = task.result()
+                results.append(result)
+                record_probe_result(config, result)
+
+                if result.ok:
+                    logger.debug(f"Successful {result.kind} probe to {result.target} in {result.latency:.6f} seconds")
+                else:
+                    logger.warning(f"Failed {result.kind} probe to {result.target} after {result.latency:.6f} seconds")
+
+                verdict = quorum.add(result.ok)
+                if verdict is not None:
+                    break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    cancelled = quorum.remaining()
+    duration = time.monotonic() - check_start
+
+    if cancelled:
+        logger.debug(f"Deep check verdict decided early, cancelled {cancelled} remaining checks")
+
+    logger.debug(f"Out of {number_total_checks_made - cancelled} checks made there were {quorum.failures} failures, deep check took {duration:.6f} seconds")
+
+    return DeepCheckResult(results, duration, verdict, cancelled)
+
+
+async def async_run_probe(kind, target, timeout):
+    probe_start = time.monotonic()
+
+    if kind == 'icmp':
+        ok = await async_ping(target[0], timeout)
+    else:
+        ok = await async_website_alive(target, timeout)
+
+    return ProbeResult(kind, target, ok, time.monotonic() - probe_start)
+
+
+async_pinger = None
+
+
+def start_async_pinger(config):
+    global async_pinger
+
+    socket_type = detect_icmp_socket_type()
+    if socket_type:
+        async_pinger = AsyncPinger(socket_type, len(config.ICMP_TARGETS))
+
+
+class AsyncPinger():
+    # One ICMP socket read by the event loop, every ping in flight shares it and replies are matched by sequence
+    def __init__(self, socket_type, expected_replies):
+        import asyncio
+
+        self.socket_type = socket_type
+        self.identifier = os.getpid() & 0xffff  # datagram sockets use their port instead
+        self.waiting = {}  # sequence -> (future, time sent)
+        self.icmp_socket = open_icmp_socket(socket_type, expected_replies)
+        self.icmp_socket.setblocking(False)
+
+        asyncio.get_running_loop().add_reader(self.icmp_socket.fileno(), self.read_replies)
+
+    def read_replies(self):
+        for sequence, received in receive_icmp_replies(self.icmp_socket, self.socket_type, self.identifier):
+            future, sent = self.waiting.pop(sequence, (None, None))
+            if future is not None and not future.done():
+                future.set_result(received - sent)
+
+    async def ping(self, target, timeout):
+        # Returns the round trip time in seconds or None
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+
+        try:
+            # The lookup counts against the timeout like it does for ping_many()
+            address = (await asyncio.wait_for(loop.getaddrinfo(cached_address(target), None, family=socket.AF_INET), timeout))[0][4][0]
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug(f"Could not resolve {target} in time: {e!r}")
+            return None
+
+        sequence = next(icmp_sequence) & 0xffff
+        future = loop.create_future()
+        self.waiting[sequence] = (future, time.monotonic())
+
+        try:
+            self.icmp_socket.sendto(build_icmp_echo(self.identifier, sequence), (address, 0))
+            return await asyncio.wait_for(future, max(0, deadline - time.monotonic()))
+        except OSError as e:
+            logger.debug(f"Could not send ICMP echo to {target}: {e}")
+            return None
+        except asyncio.TimeoutError:
+            logger.debug(f"No ICMP echo reply from {target} within {timeout} seconds")
+            return None
+        finally:
+            # Also reached when the deep check cancels this probe
+            self.waiting.pop(sequence, None)
+
+
+async def async_ping(target, timeout):
+    import asyncio
+
+    if async_pinger is not None:
+        return await async_pinger.ping(target, timeout) is not None
+
+    # Only without ICMP socket access, one ping process per probe
+    process = await asyncio.create_subprocess_exec(
+        'ping', '-b', '-c', '1', '-n', '-p', 'ff', '-W', str(timeout), cached_address(target),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    try:
+        return await asyncio.wait_for(process.wait(), timeout * 1.25) == 0
+    except asyncio.TimeoutError:
+        logger.debug(f"Ping of {target} did not complete within {timeout * 1.25} seconds")
+        return False
+    finally:
+        # Also reached when the deep check cancels this probe
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+async def async_website_alive(url, timeout):
+    # The hard timeout covers name resolution too, which is why website_alive() needs a Process
+    import asyncio
+
+    try:
+        return await asyncio.wait_for(async_http_head(url), timeout)
+    except asyncio.TimeoutError:
+        logger.debug(f"Timeout of {timeout} reached for {url}")
+        return False
+    except (OSError, ValueError) as e:
+        logger.debug(e)
+        return False
+
+
+async def async_http_head(url):
+    import asyncio
+
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    if secure:
+        reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=True)
+    else:
+        reader, writer = await asyncio.open_connection(cached_address(parts.hostname), port)
+
+    try:
+        writer.write(
+            f"HEAD {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: nsm/{__version__}\r\nConnection: close\r\n\r\n".encode('ascii')
+        )
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line.startswith(b'HTTP/'):
+            raise ValueError(f"Not an HTTP response from {url}: {status_line!r}")
+
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            headers.append(line)
+    finally:
+        writer.close()
+
+    logger.debug(f"async_website_alive: {status_line.strip()!r} from {url}")
+    # In the event the connection was made but no response do a sanity check
+    return bool(headers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# nsm.py is a single script at the top of the repository, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
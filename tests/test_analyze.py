@@ -0,0 +1,127 @@
+import datetime
+import gzip
+import random
+
+import nsm
+
+
+def write_log(path, seed=7):
+    # A few days of heartbeats with outages, a recovery that never got logged, false alarms and resolver failures
+    generator = random.Random(seed)
+    now = datetime.datetime(2025, 4, 1, 23, 30)
+    lines = []
+
+    def line(level, message):
+        lines.append(f"{now.isoformat(sep=' ', timespec='milliseconds').replace('.', ',')} {level:<8} {message}\n")
+
+    while len(lines) < 40000:
+        now += datetime.timedelta(seconds=1)
+        roll = generator.random()
+
+        if roll < 0.002:
+            line('WARNING', 'Failed to resolve using (\'8.8.8.8\', \'www.google.com\'). Network may be down, kicking off deep check')
+            line('ERROR', 'New outage detected')
+            if generator.random() < 0.1:
+                continue  # monitor restarted before the recovery
+            outage = datetime.timedelta(seconds=generator.uniform(2, 9000))
+            now += outage
+            line('INFO', 'Saw recovery from network outage')
+            line('INFO', f"Duration of outage was {outage}")
+        elif roll < 0.004:
+            line('WARNING', 'Failed to resolve using (\'1.1.1.1\', \'www.example.com\'). Network may be down, kicking off deep check')
+            line('DEBUG', 'False alarm, deep check of network passed; no outage')
+        elif roll < 0.005:
+            line('ERROR', 'Unexpected error')
+            lines.append('Traceback (most recent call last):\n  New outage detected in a continuation line\n')
+        else:
+            line('DEBUG', 'Network connection test passed with DNS pair (\'8.8.8.8\', \'www.google.com\') answering 142.250.80.36')
+
+    with open(path, 'w', encoding='utf-8') as log_file:
+        log_file.writelines(lines)
+
+
+def one_pass(path):
+    analysis, scanned = nsm.analyze_log_part(path, None, None, 'hour')
+    return analysis
+
+
+def results(analysis):
+    fields = vars(analysis).copy()
+    fields['periods'] = {period: [counts[0], round(counts[1], 6), counts[2]] for period, counts in fields['periods'].items()}
+    fields['downtime'] = round(fields['downtime'], 6)
+    return fields
+
+
+def test_log_events_parses_markers(tmp_path):
+    path = str(tmp_path / 'network-monitor.log')
+    with open(path, 'w') as log_file:
+        log_file.write('2025-04-02 10:11:12,345 ERROR    New outage detected\n')
+        log_file.write('2025-04-02 12:11:12,345 INFO     Duration of outage was 1 day, 2:00:00.500000\n')
+
+    events = [event[1:] for event in nsm.log_events(open(path, 'rb').read())]
+
+    assert events == [('seen', None), ('outage', None), ('recovered', 93600.5), ('seen', None)]
+
+
+def test_chunks_give_the_same_result_as_one_pass(tmp_path, monkeypatch):
+    path = str(tmp_path / 'network-monitor.log')
+    write_log(path)
+    monkeypatch.setattr(nsm, 'LOG_MIN_CHUNK', 1024)
+
+    chunks = nsm.log_chunks(path, 50)
+    assert len(chunks) == 50
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(open(path, 'rb').read())
+
+    merged = nsm.LogAnalysis('hour')
+    for start, end in chunks:
+        merged.merge(nsm.analyze_log_part(path, start, end, 'hour')[0])
+
+    expected = one_pass(path)
+    assert expected.outages and expected.unrecovered and expected.false_alarms
+    assert results(merged) == results(expected)
+
+
+def test_merge_closes_an_outage_left_open_by_the_previous_part():
+    earlier = nsm.LogAnalysis()
+    earlier.add(1000.0, 'outage', None)
+
+    later = nsm.LogAnalysis()
+    later.add(1060.0, 'recovered', 60.0)
+    later.add(2000.0, 'outage', None)
+
+    earlier.merge(later)
+
+    assert (earlier.outages, earlier.unrecovered, earlier.open_start) == (1, 0, 2000.0)
+
+
+def test_merge_counts_an_outage_that_never_recovered():
+    earlier = nsm.LogAnalysis()
+    earlier.add(1000.0, 'outage', None)
+
+    later = nsm.LogAnalysis()
+    later.add(2000.0, 'outage', None)
+
+    earlier.merge(later)
+
+    assert (earlier.outages, earlier.unrecovered, earlier.open_start) == (0, 1, 2000.0)
+
+
+def test_gzip_log_matches_plain_log(tmp_path):
+    path = str(tmp_path / 'network-monitor.log')
+    write_log(path, seed=11)
+    with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+        target.write(source.read())
+
+    assert results(one_pass(path + '.gz')) == results(one_pass(path))
+
+
+def test_worker_processes_match_one_job(tmp_path, monkeypatch):
+    path = str(tmp_path / 'network-monitor.log')
+    write_log(path, seed=3)
+    monkeypatch.setattr(nsm, 'LOG_MIN_CHUNK', 1024)
+
+    single, single_scanned = nsm.analyze_logs([path], 'day', 1)
+    parallel, parallel_scanned = nsm.analyze_logs([path], 'day', 2)
+
+    assert results(parallel) == results(single)
+    assert parallel_scanned == single_scanned
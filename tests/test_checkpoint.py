@@ -0,0 +1,112 @@
+import sqlite3
+import types
+
+import pytest
+
+import nsm
+
+
+def checkpoint(tmp_path):
+    return nsm.OutageCheckpoint(str(tmp_path / 'outage.checkpoint'), 300)
+
+
+def test_new_checkpoint_is_empty(tmp_path):
+    assert checkpoint(tmp_path).read() == (0, 0.0, 0.0, 0.0)
+
+
+def test_reopened_checkpoint_has_the_last_save(tmp_path):
+    first = checkpoint(tmp_path)
+    first.save(1000.0, 900.0)
+    first.tick(False)
+
+    sequence, start_of_failure, last_success, last_tick = checkpoint(tmp_path).read()
+
+    assert (sequence, start_of_failure, last_success) == (2, 1000.0, 900.0)
+    assert last_tick == first.last_tick
+
+
+def test_torn_slot_falls_back_to_the_other_one(tmp_path):
+    first = checkpoint(tmp_path)
+    first.save(1000.0, 900.0)  # sequence 1, slot 1
+    first.save(None, 1200.0)  # sequence 2, slot 0
+
+    # A crash half way through writing sequence 2 leaves a slot whose CRC does not match
+    first.map[16:24] = b'\xff' * 8
+
+    assert checkpoint(tmp_path).read()[:3] == (1, 1000.0, 900.0)
+
+
+def test_both_slots_torn_reads_as_empty(tmp_path):
+    first = checkpoint(tmp_path)
+    first.save(1000.0, 900.0)
+    first.save(None, 1200.0)
+
+    first.map[16:24] = b'\xff' * 8
+    first.map[nsm.OutageCheckpoint.SLOT_SIZE + 16:nsm.OutageCheckpoint.SLOT_SIZE + 24] = b'\xff' * 8
+
+    assert checkpoint(tmp_path).read() == (0, 0.0, 0.0, 0.0)
+
+
+def heartbeats_until(now, end, outage_checkpoint):
+    # Failed heartbeats every 5 seconds
+    while now[0] < end:
+        now[0] += 5
+        nsm.rollups.sample('dns 8.8.8.8', False, None)
+        outage_checkpoint.tick(False)
+
+
+def test_resumed_outage_is_not_counted_twice_in_the_rollups(tmp_path, monkeypatch):
+    # 200 second outage, the monitor stops 100 seconds in and is back 10 seconds later
+    now = [1700006400.0 + 3600 + 60]
+    monkeypatch.setattr(nsm.time, 'time', lambda: now[0])
+    config = nsm.Config()
+    config.ROLLUP_DB = str(tmp_path / 'rollups.db')
+    config.JOURNAL_COMMIT_DELAY = 0
+    outage_start = now[0]
+
+    monkeypatch.setattr(nsm, 'rollups', nsm.RollupEngine(config))
+    nsm.rollups.start()
+    nsm.rollups.outage_started(outage_start)
+    first = checkpoint(tmp_path)
+    first.save(outage_start, None)
+    heartbeats_until(now, now[0] + 100, first)
+    nsm.rollups.close()
+
+    now[0] += 10
+    monkeypatch.setattr(nsm, 'rollups', nsm.RollupEngine(config))
+    nsm.rollups.start()
+    tracker = types.SimpleNamespace(start_of_failure=None, last_success=None)
+    checkpoint(tmp_path).restore(tracker)
+    assert tracker.start_of_failure == outage_start
+    heartbeats_until(now, now[0] + 90, checkpoint(tmp_path))
+    nsm.rollups.outage_ended(tracker.start_of_failure, now[0])
+    nsm.rollups.close()
+
+    with sqlite3.connect(config.ROLLUP_DB) as connection:
+        rows = dict(connection.execute("SELECT level, SUM(outage_seconds) FROM rollups WHERE target = 'network' GROUP BY level"))
+
+    assert rows == {'1m': pytest.approx(200), '1h': pytest.approx(200), '1d': pytest.approx(200)}
+
+
+def test_heartbeats_are_synced_at_most_once_a_sync_interval(tmp_path, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(nsm.time, 'monotonic', lambda: now[0])
+    first = checkpoint(tmp_path)
+
+    first.save(1000.0, 900.0)
+    assert first.synced_at == 100.0
+
+    now[0] += 0.1
+    first.tick(False)
+    now[0] += 0.1
+    first.tick(True)
+    assert first.synced_at == 100.0
+    assert checkpoint(tmp_path).read()[0] == 3  # still in the mapping, and so in the page cache
+
+    now[0] += 1.0
+    first.tick(True)
+    assert first.synced_at == pytest.approx(101.2)
+
+    now[0] += 0.1
+    first.save(None, 1000.0)
+    assert first.synced_at == pytest.approx(101.3)
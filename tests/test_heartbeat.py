@@ -0,0 +1,154 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import nsm
+
+
+class Resolver():
+    # Answers each query on a local UDP port with whatever reply(query) returns, a list of packets sent in order
+    def __init__(self, reply, delay=0.0, address='127.0.0.1', port=0):
+        self.reply = reply
+        self.delay = delay
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((address, port))
+        self.port = self.socket.getsockname()[1]
+        self.queries = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                query, address = self.socket.recvfrom(512)
+            except OSError:
+                return
+            self.queries += 1
+            time.sleep(self.delay)
+            for packet in self.reply(query):
+                self.socket.sendto(packet, address)
+
+    def close(self):
+        self.socket.close()
+
+
+def response(query, flags=0x8180, answers=1, transaction_id=None):
+    transaction_id = struct.unpack_from('!H', query)[0] if transaction_id is None else transaction_id
+    return struct.pack('!HHHHHH', transaction_id, flags, 1, answers, 0, 0) + bytes(query[12:])
+
+
+@pytest.fixture
+def resolvers():
+    started = []
+
+    def start(reply, delay=0.0, address='127.0.0.1', port=0):
+        resolver = Resolver(reply, delay, address, port)
+        started.append(resolver)
+        return resolver
+
+    yield start
+
+    for resolver in started:
+        resolver.close()
+
+
+def heartbeat(port, pairs=1, timeout=0.5):
+    return nsm.DnsHeartbeat([('127.0.0.1', 'www.example.com')] * pairs, timeout, port)
+
+
+def test_query_is_a_recursive_a_question():
+    query = nsm.build_dns_query('www.example.com.')
+
+    assert query[:12] == struct.pack('!HHHHHH', 0, 0x0100, 1, 0, 0, 0)
+    assert query[12:] == b'\x03www\x07example\x03com\x00\x00\x01\x00\x01'
+
+
+def test_good_answer_counts_its_records(resolvers):
+    resolver = resolvers(lambda query: [response(query, answers=2)])
+
+    assert heartbeat(resolver.port).probe(0) == 2
+
+
+def test_late_replies_and_queries_are_skipped(resolvers):
+    resolver = resolvers(lambda query: [
+        response(query, transaction_id=struct.unpack_from('!H', query)[0] ^ 1),  # answer to an earlier query
+        response(query, flags=0x0100),  # not a response
+        b'\x00' * 5,  # too short for a header
+        response(query),
+    ])
+
+    assert heartbeat(resolver.port).probe(0) == 1
+
+
+@pytest.mark.parametrize('flags, answers', [(0x8182, 1), (0x8183, 0), (0x8180, 0)])
+def test_error_or_empty_answer_fails(resolvers, flags, answers):
+    resolver = resolvers(lambda query: [response(query, flags=flags, answers=answers)])
+
+    assert heartbeat(resolver.port).probe(0) == 0
+
+
+def test_silent_resolver_times_out(resolvers):
+    resolver = resolvers(lambda query: [])
+    started = time.monotonic()
+
+    assert heartbeat(resolver.port, timeout=0.2).probe(0) == 0
+    assert 0.2 <= time.monotonic() - started < 0.5
+
+
+def test_query_id_changes_every_send(resolvers):
+    seen = []
+    resolver = resolvers(lambda query: seen.append(query[:2]) or [response(query)])
+    fast_path = heartbeat(resolver.port)
+
+    for _ in range(20):
+        assert fast_path.probe(0) == 1
+
+    assert len(set(seen)) > 1
+
+
+def hedged_heartbeat(resolvers, primary_reply, other_reply, primary_delay=0.0):
+    # Primary on 127.0.0.1 and the pair it hedges to on 127.0.0.2, both on the same port
+    primary = resolvers(primary_reply, primary_delay)
+    other = resolvers(other_reply, address='127.0.0.2', port=primary.port)
+    pairs = [('127.0.0.1', 'www.example.com'), ('127.0.0.2', 'www.example.com')]
+    return nsm.DnsHeartbeat(pairs, 0.5, primary.port), other
+
+
+def test_fast_primary_is_not_hedged(resolvers):
+    fast_path, other = hedged_heartbeat(resolvers, lambda query: [response(query)], lambda query: [response(query)])
+
+    answered_by, answer_count, rtt = fast_path.hedged_probe(0, 0.2, 1)
+
+    assert (answered_by, answer_count) == (0, 1)
+    assert rtt < 0.2
+    assert (fast_path.hedges, other.queries) == (0, 0)
+
+
+def test_hedge_answers_for_a_silent_primary_with_its_own_time(resolvers):
+    fast_path, other = hedged_heartbeat(resolvers, lambda query: [], lambda query: [response(query)])
+
+    started = time.monotonic()
+    answered_by, answer_count, rtt = fast_path.hedged_probe(0, 0.2, 1)
+
+    assert (answered_by, answer_count) == (1, 1)
+    assert time.monotonic() - started >= 0.2
+    assert rtt < 0.1  # not charged for the 0.2 seconds waited on the primary
+    assert (fast_path.hedges, fast_path.hedge_wins) == (1, 1)
+
+
+def test_slow_primary_can_still_win_after_hedging(resolvers):
+    fast_path, other = hedged_heartbeat(resolvers, lambda query: [response(query)], lambda query: [], primary_delay=0.15)
+
+    answered_by, answer_count, rtt = fast_path.hedged_probe(0, 0.1, 1)
+
+    assert (answered_by, answer_count) == (0, 1)
+    assert rtt >= 0.15
+    assert (fast_path.hedges, fast_path.hedge_wins, other.queries) == (1, 0, 1)
+
+
+def test_hedged_heartbeat_fails_when_nobody_answers(resolvers):
+    fast_path, other = hedged_heartbeat(resolvers, lambda query: [], lambda query: [])
+
+    assert fast_path.hedged_probe(0, 0.1, 1, timeout=0.3) == (None, 0, None)
@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+import nsm
+
+
+def test_histogram_small_values_are_exact():
+    histogram = nsm.LatencyHistogram(5)
+    for microseconds in range(32):
+        assert histogram.bucket_range(histogram.bucket_index(microseconds)) == (microseconds, microseconds)
+
+
+def test_histogram_buckets_cover_every_value_once():
+    histogram = nsm.LatencyHistogram(5)
+    expected_low = 0
+    for index in range(histogram.bucket_index(nsm.LatencyHistogram.MAX_MICROSECONDS - 1) + 1):
+        low, high = histogram.bucket_range(index)
+        assert low == expected_low
+        assert histogram.bucket_index(low) == index and histogram.bucket_index(high) == index
+        expected_low = high + 1
+
+
+def test_histogram_quantiles_within_bucket_accuracy():
+    generator = random.Random(1)
+    values = sorted(generator.lognormvariate(-4, 1) for _ in range(20000))
+    histogram = nsm.LatencyHistogram(5)
+    for value in values:
+        histogram.record(value)
+
+    for fraction in (0.5, 0.99, 0.999):
+        true = values[int(fraction * len(values)) - 1]
+        assert histogram.quantile(fraction) == pytest.approx(true, rel=2 ** -5)
+
+
+def test_histogram_merge_is_the_same_as_recording_everything():
+    generator = random.Random(2)
+    values = [generator.expovariate(50) for _ in range(5000)]
+    whole, first, second = (nsm.LatencyHistogram(5) for _ in range(3))
+    for position, value in enumerate(values):
+        whole.record(value)
+        (first if position % 2 else second).record(value)
+
+    first.merge(second)
+
+    assert (first.counts, first.total, first.max) == (whole.counts, whole.total, whole.max)
+
+
+def test_histogram_clamps_very_slow_values():
+    histogram = nsm.LatencyHistogram(5)
+    histogram.record(1000.0)
+
+    assert histogram.max == nsm.LatencyHistogram.MAX_MICROSECONDS - 1
+
+
+def test_histogram_only_keeps_buckets_that_were_hit():
+    histogram = nsm.LatencyHistogram(5)
+    for _ in range(1000):
+        histogram.record(0.020)
+    histogram.record(0.021)
+
+    assert histogram.counts == {histogram.bucket_index(20000): 1000, histogram.bucket_index(21000): 1}
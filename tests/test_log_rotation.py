@@ -0,0 +1,55 @@
+import gzip
+import os
+
+import nsm
+
+
+UNRELATED = ['nsm.log', 'nsm.log.bak', 'nsm.log.db', 'nsm.log.foo.tmp', 'nsm.log.20240101-000000.old', 'other.log.20240101-000000']
+
+
+def touch(directory, *names):
+    for name in names:
+        (directory / name).write_text(name)
+
+
+def names(paths):
+    return [os.path.basename(path) for path in paths]
+
+
+def test_rotated_files_skip_unrelated_names_and_are_oldest_first(tmp_path):
+    touch(tmp_path, *UNRELATED)
+    touch(tmp_path, 'nsm.log.20240102-000000', 'nsm.log.20240101-120000-2.gz', 'nsm.log.20240101-120000.gz',
+          'nsm.log.20240101-120000-10', 'nsm.log.20240101-000000.zst', 'nsm.log.20240103-000000.gz.tmp')
+    compressor = nsm.LogCompressor(str(tmp_path / 'nsm.log'), 0, 'gzip')
+
+    assert names(compressor.rotated_files()) == [
+        'nsm.log.20240101-000000.zst', 'nsm.log.20240101-120000.gz', 'nsm.log.20240101-120000-2.gz',
+        'nsm.log.20240101-120000-10', 'nsm.log.20240102-000000',
+    ]
+    assert names(compressor.rotated_files(temporary=True)) == ['nsm.log.20240103-000000.gz.tmp']
+
+
+def test_start_only_cleans_up_and_queues_rotated_logs(tmp_path):
+    touch(tmp_path, *UNRELATED)
+    touch(tmp_path, 'nsm.log.20240101-000000', 'nsm.log.20240102-000000.gz', 'nsm.log.20240102-000000-1.gz.tmp')
+    compressor = nsm.LogCompressor(str(tmp_path / 'nsm.log'), 0, 'gzip')
+    compressor.run = lambda: None
+
+    compressor.start()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(UNRELATED + ['nsm.log.20240101-000000', 'nsm.log.20240102-000000.gz'])
+    assert names([compressor.jobs.get_nowait()]) == ['nsm.log.20240101-000000']
+    assert compressor.jobs.empty()
+
+
+def test_retention_only_removes_the_oldest_rotated_logs(tmp_path):
+    touch(tmp_path, *UNRELATED)
+    touch(tmp_path, 'nsm.log.20240101-000000.gz', 'nsm.log.20240102-000000.gz', 'nsm.log.20240103-000000')
+    compressor = nsm.LogCompressor(str(tmp_path / 'nsm.log'), 2, 'gzip')
+
+    compressor.compress(str(tmp_path / 'nsm.log.20240103-000000'))
+    compressor.enforce_retention()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(UNRELATED + ['nsm.log.20240102-000000.gz', 'nsm.log.20240103-000000.gz'])
+    with gzip.open(tmp_path / 'nsm.log.20240103-000000.gz', 'rt') as compressed:
+        assert compressed.read() == 'nsm.log.20240103-000000'
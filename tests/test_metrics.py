@@ -0,0 +1,67 @@
+import nsm
+
+
+def metrics(buckets=(0.01, 0.1)):
+    config = nsm.Config()
+    config.DNS_PAIRS = [('192.0.2.53', 'example.com')]
+    config.ICMP_TARGETS = []
+    config.WEB_TARGETS = []
+    config.METRICS_LATENCY_BUCKETS = list(buckets)
+    return nsm.Metrics(config)
+
+
+def test_render_counter_with_escaped_labels():
+    registry = metrics()
+    registry.inc('nsm_heartbeats_total', (('resolver', 'a"b\\c'), ('result', 'success')))
+    registry.inc('nsm_heartbeats_total', (('resolver', 'a"b\\c'), ('result', 'success')), 2)
+
+    assert registry.render(registry.families['nsm_heartbeats_total']) == (
+        '# HELP nsm_heartbeats_total Heartbeat DNS queries by resolver and result\n'
+        '# TYPE nsm_heartbeats_total counter\n'
+        'nsm_heartbeats_total{resolver="a\\"b\\\\c",result="success"} 3\n'
+    )
+
+
+def test_render_histogram_buckets_are_cumulative():
+    registry = metrics()
+    for rtt in (0.005, 0.01, 0.05, 3.0):
+        registry.observe('nsm_probe_latency_seconds', rtt, (('kind', 'icmp'), ('target', '192.0.2.1')))
+
+    assert registry.render(registry.families['nsm_probe_latency_seconds']).splitlines()[2:] == [
+        'nsm_probe_latency_seconds_bucket{kind="icmp",target="192.0.2.1",le="0.01"} 2',
+        'nsm_probe_latency_seconds_bucket{kind="icmp",target="192.0.2.1",le="0.1"} 3',
+        'nsm_probe_latency_seconds_bucket{kind="icmp",target="192.0.2.1",le="+Inf"} 4',
+        'nsm_probe_latency_seconds_sum{kind="icmp",target="192.0.2.1"} 3.065',
+        'nsm_probe_latency_seconds_count{kind="icmp",target="192.0.2.1"} 4',
+    ]
+
+
+def test_exposition_starts_unlabelled_families_at_zero():
+    text = metrics().exposition()
+
+    assert 'nsm_outages_total 0\n' in text
+    assert 'nsm_current_outage_seconds 0\n' in text
+    assert '\nnsm_heartbeats_total' not in text and '\nnsm_scheduler_lag_seconds' not in text
+
+
+def test_exposition_is_reused_until_something_changes():
+    registry = metrics()
+    registry.exposition()
+    cached = registry.exposition_text
+    other_family = registry.families['nsm_deep_checks_total'].text
+
+    registry.exposition()
+    assert registry.exposition_text is cached
+
+    registry.inc('nsm_outages_total')
+    assert registry.exposition_text is None
+    assert 'nsm_outages_total 1\n' in registry.exposition()
+    assert registry.families['nsm_deep_checks_total'].text is other_family
+
+
+def test_current_outage_age_is_computed_at_scrape_time(monkeypatch):
+    registry = metrics()
+    registry.set('nsm_outage_start_timestamp_seconds', 1000.0)
+    monkeypatch.setattr(nsm.time, 'time', lambda: 1042.5)
+
+    assert registry.exposition().endswith('nsm_current_outage_seconds 42.5\n')
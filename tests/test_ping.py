@@ -0,0 +1,37 @@
+import socket
+import time
+
+import pytest
+
+import nsm
+
+
+pytestmark = pytest.mark.skipif(not nsm.detect_icmp_socket_type(), reason='ICMP sockets are not available')
+
+
+def test_slow_lookup_fails_without_holding_up_the_rest(monkeypatch):
+    real_getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(host, *args, **kwargs):
+        if host.startswith('slow'):
+            time.sleep(3)
+        return real_getaddrinfo('127.0.0.1', *args, **kwargs)
+
+    monkeypatch.setattr(nsm.socket, 'getaddrinfo', getaddrinfo)
+
+    started = time.monotonic()
+    results = nsm.ping_many(['slow.example', 'fast.example', '127.0.0.1'], 1)
+
+    assert time.monotonic() - started < 2
+    assert results['slow.example'] is None
+    assert results['fast.example'] is not None
+    assert results['127.0.0.1'] is not None
+
+
+def test_unresolvable_name_is_a_failure(monkeypatch):
+    def getaddrinfo(host, *args, **kwargs):
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    monkeypatch.setattr(nsm.socket, 'getaddrinfo', getaddrinfo)
+
+    assert nsm.ping_many(['missing.example', '127.0.0.1'], 1)['missing.example'] is None
@@ -0,0 +1,21 @@
+import nsm
+
+
+def test_quorum_decides_as_soon_as_the_rest_cannot_change_it():
+    quorum = nsm.QuorumEvaluator(5, 0.5)  # outage when more than 2.5 fail
+
+    assert quorum.add(False) is None
+    assert quorum.add(False) is None
+    assert quorum.add(False) is True
+
+
+def test_quorum_no_outage_once_enough_succeed():
+    quorum = nsm.QuorumEvaluator(5, 0.5)
+
+    assert quorum.add(True) is None
+    assert quorum.add(True) is None
+    assert quorum.add(True) is False
+
+
+def test_quorum_with_no_probes_is_no_outage():
+    assert nsm.QuorumEvaluator(0, 0.5).verdict() is False
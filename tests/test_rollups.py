@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import nsm
+
+DAY = 1700006400  # 2023-11-15 00:00 UTC
+
+
+class Clock():
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(DAY + 3600)
+    monkeypatch.setattr(nsm.time, 'time', clock)
+    return clock
+
+
+def rollup_engine(tmp_path):
+    config = nsm.Config()
+    config.ROLLUP_DB = str(tmp_path / 'rollups.db')
+    config.JOURNAL_COMMIT_DELAY = 0
+    engine = nsm.RollupEngine(config)
+    engine.start()
+    return engine
+
+
+def outage_seconds(tmp_path, level):
+    with sqlite3.connect(str(tmp_path / 'rollups.db')) as connection:
+        return dict(connection.execute('SELECT start, outage_seconds FROM rollups WHERE level = ? AND target = ?', (level, nsm.ROLLUP_NETWORK)))
+
+
+def test_outage_seconds_are_split_over_the_periods_it_covers(tmp_path, clock):
+    engine = rollup_engine(tmp_path)
+    outage_start = DAY + 3600 + 30
+
+    while clock.now < DAY + 3600 + 300:
+        engine.sample('dns 8.8.8.8', clock.now < outage_start, 0.02)
+        if clock.now == outage_start:
+            engine.outage_started(outage_start)
+        clock.now += 5
+
+    engine.outage_ended(outage_start, clock.now)  # 270 seconds later
+    engine.close()
+
+    minutes = outage_seconds(tmp_path, '1m')
+    assert minutes[DAY + 3600] == pytest.approx(30)
+    assert minutes[DAY + 3660] == pytest.approx(60)
+    assert sum(minutes.values()) == pytest.approx(270)
+    assert outage_seconds(tmp_path, '1h') == {DAY + 3600: pytest.approx(270)}
+    assert outage_seconds(tmp_path, '1d') == {DAY: pytest.approx(270)}
+
+
+def test_periods_without_an_outage_count_none(tmp_path, clock):
+    engine = rollup_engine(tmp_path)
+
+    for _ in range(30):
+        engine.sample('dns 8.8.8.8', True, 0.02)
+        clock.now += 5
+    engine.close()
+
+    assert set(outage_seconds(tmp_path, '1m').values()) == {0.0}
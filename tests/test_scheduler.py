@@ -0,0 +1,62 @@
+import pytest
+
+import nsm
+
+
+class Clock():
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(nsm.time, 'monotonic', clock)
+    return clock
+
+
+def test_scheduler_ticks_on_the_interval_grid(clock):
+    scheduler = nsm.FixedRateScheduler(1.0)
+
+    assert scheduler.delay() == 0.0
+    clock.now += 0.3
+    assert scheduler.delay() == pytest.approx(0.7)
+    clock.now += 0.7
+    clock.now += 0.25  # a check that took a quarter of a second
+    assert scheduler.delay() == pytest.approx(0.75)
+    assert scheduler.missed_ticks == 0
+
+
+def test_scheduler_skips_ticks_missed_by_an_overrun(clock):
+    scheduler = nsm.FixedRateScheduler(1.0, 'skip')
+    scheduler.delay()
+
+    clock.now += 3.5  # ticks 1 and 2 missed, tick 3 runs late
+    assert scheduler.delay() == 0.0
+    assert scheduler.missed_ticks == 2
+    assert scheduler.blind_seconds == pytest.approx(2.0)
+    assert scheduler.delay() == pytest.approx(0.5)  # back on the grid at tick 4
+
+
+def test_scheduler_catches_up_without_counting_a_gap_twice(clock):
+    scheduler = nsm.FixedRateScheduler(1.0, 'catch-up')
+    scheduler.delay()
+
+    clock.now += 3.5
+    assert [scheduler.delay() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert scheduler.missed_ticks == 2
+    assert scheduler.delay() == pytest.approx(0.5)
+
+
+def test_scheduler_interval_change_counts_from_the_last_tick(clock):
+    scheduler = nsm.FixedRateScheduler(1.0)
+    scheduler.delay()
+    clock.now += 1.0
+    scheduler.delay()  # tick 1 at 101
+
+    scheduler.set_interval(10.0)
+    clock.now += 0.5
+    assert scheduler.delay() == pytest.approx(9.5)
@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+import nsm
+
+
+def test_sketch_quantiles_within_relative_accuracy():
+    generator = random.Random(3)
+    values = sorted(generator.lognormvariate(-3, 1.5) for _ in range(20000))
+    sketch = nsm.QuantileSketch.for_accuracy(0.02, 2048)
+    for value in values:
+        sketch.add(value)
+
+    for fraction in (0.5, 0.95, 0.99):
+        true = values[int(fraction * (len(values) - 1))]
+        assert sketch.quantile(fraction) == pytest.approx(true, rel=0.02)
+
+
+def test_sketch_merge_is_the_same_as_adding_everything():
+    generator = random.Random(4)
+    whole, first, second = (nsm.QuantileSketch.for_accuracy(0.02, 256) for _ in range(3))
+    for position in range(5000):
+        value = generator.uniform(0.001, 0.5)
+        whole.add(value)
+        (first if position % 3 else second).add(value)
+
+    first.merge(second)
+
+    assert (first.buckets, first.count) == (whole.buckets, whole.count)
+
+
+def test_sketch_collapse_keeps_the_bucket_limit_and_the_high_quantiles():
+    sketch = nsm.QuantileSketch.for_accuracy(0.02, 16)
+    values = [1.1 ** exponent * 1e-4 for exponent in range(100)]
+    for value in values:
+        sketch.add(value)
+
+    assert len(sketch.buckets) == 16
+    assert sketch.count == 100
+    assert sketch.quantile(0.99) == pytest.approx(values[98], rel=0.02)
+
+
+def test_empty_sketch_has_no_quantile():
+    assert nsm.QuantileSketch.for_accuracy(0.02, 16).quantile(0.5) is None
@@ -0,0 +1,38 @@
+import types
+
+import nsm
+
+
+def entry():
+    return types.SimpleNamespace(rounds=0)
+
+
+def test_timing_wheel_returns_entries_in_their_tick():
+    wheel = nsm.TimingWheel(0.1, 8, 0.0)
+    soon, later = entry(), entry()
+    wheel.add(soon, 0.25)
+    wheel.add(later, 0.5)
+
+    due = [wheel.advance() for _ in range(6)]
+
+    assert due == [[], [], [soon], [], [], [later]]
+
+
+def test_timing_wheel_entries_past_one_turn_wait_whole_turns():
+    wheel = nsm.TimingWheel(0.1, 8, 0.0)
+    far = entry()
+    wheel.add(far, 2.05)  # tick 20, two and a half turns away
+
+    due_at = [tick for tick in range(24) if wheel.advance()]
+
+    assert due_at == [20]
+
+
+def test_timing_wheel_overdue_entry_goes_in_the_current_tick():
+    wheel = nsm.TimingWheel(0.1, 8, 0.0)
+    for _ in range(5):
+        wheel.advance()
+    late = entry()
+    wheel.add(late, 0.1)
+
+    assert wheel.advance() == [late]